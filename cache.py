@@ -0,0 +1,437 @@
+#!/usr/bin/env python
+"""
+Author:  prashmohan@gmail.com
+         http://www.cs.berkeley.edu/~prmohan
+        
+Copyright (c) 2011, University of California at Berkeley
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of University of California, Berkeley nor the
+      names of its contributors may be used to endorse or promote products
+      derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL PRASHANTH MOHAN BE LIABLE FOR ANY
+DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import re
+import json
+import logging
+import threading
+import numpy as np
+from common import to_epoch
+from rollup import merge_rollups
+
+log = logging.getLogger(__name__)
+
+
+def _write_entry(directory, arrays, header_path, header):
+    """Write a cache entry into `directory': the .npy files given as
+    (path, array) pairs, then the JSON header. Every file is written
+    under a temporary name and renamed into place, and the header is
+    written last, so that a partially written entry is never
+    considered valid"""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    files = [(path, lambda f, array=array: np.save(f, array)) for path, array in arrays]
+    files.append((header_path, lambda f: json.dump(header, f)))
+    for path, writer in files:
+        tmp_path = path + '.tmp'
+        f = open(tmp_path, 'wb')
+        try:
+            writer(f)
+        finally:
+            f.close()
+        os.rename(tmp_path, path)
+
+
+class TraceCache(object):
+    """On disk cache of parsed trace files.
+
+    Every trace file (one month of a sensor) is stored as two .npy
+    arrays, the timestamps (seconds since epoch) and the values, along
+    with a small JSON header that holds the number of records, the
+    time bounds and the modification time and size of the source
+    file. Cached months are memory mapped on load. A month is parsed
+    again whenever its source file changes, unless records were only
+    appended to it (see append).
+
+    The hourly and daily rollups of a month (see rollup.py) are kept
+    the same way, under a header of their own, so that they can be
+    cached for sources that are not parsed (raw archives) as well."""
+
+    DIR_NAME = '.cache'
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_header(self, source, stat=None, validate=True):
+        """Return the header of the cached copy of `source' or None if
+        there is no valid cached copy. With `validate' unset, a header
+        of a stale copy is returned as well"""
+        if stat is None:
+            stat = os.stat(source)
+        try:
+            header = json.load(open(self.__path(source, 'hdr'), 'r'))
+        except (IOError, ValueError):
+            return None
+        if header.get('version') != self.VERSION:
+            return None
+        if validate and (header.get('mtime') != stat.st_mtime or \
+                             header.get('size') != stat.st_size):
+            return None
+        return header
+
+    def load(self, source, header):
+        """Return the cached timestamps and values of `source' as
+        memory mapped arrays. `header' is as returned by get_header"""
+        if not header['count']:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return np.load(self.__path(source, 'ts.npy'), mmap_mode='r'), \
+            np.load(self.__path(source, 'val.npy'), mmap_mode='r')
+
+    def put(self, source, timestamps, values, size=None, mtime=None):
+        """Store the records of `source' in the cache. `size' and
+        `mtime' describe the part of the source file the records were
+        read from and default to the current state of the file. Failure
+        to write the cache is logged and otherwise ignored"""
+        if size is None or mtime is None:
+            stat = os.stat(source)
+            size = stat.st_size if size is None else size
+            mtime = stat.st_mtime if mtime is None else mtime
+        header = {'version': self.VERSION,
+                  'mtime': mtime,
+                  'size': size,
+                  'count': len(timestamps),
+                  'min_time': int(timestamps.min()) if len(timestamps) else None,
+                  'max_time': int(timestamps.max()) if len(timestamps) else None}
+        try:
+            _write_entry(self.directory,
+                         [(self.__path(source, 'ts.npy'), np.asarray(timestamps, dtype=np.int64)),
+                          (self.__path(source, 'val.npy'), np.asarray(values, dtype=np.float64))],
+                         self.__path(source, 'hdr'), header)
+        except (IOError, OSError) as e:
+            log.warn('Could not cache ' + source + ': ' + str(e))
+
+    def append(self, source, timestamps, values, offset, size, mtime):
+        """Add the records parsed from bytes [offset, size) of
+        `source' to its cached copy. Nothing is stored unless the cached
+        copy ends at `offset'"""
+        header = self.get_header(source, validate=False)
+        if not header or header['size'] != offset:
+            return
+        cached_timestamps, cached_values = self.load(source, header)
+        self.put(source,
+                 np.concatenate((cached_timestamps, timestamps)),
+                 np.concatenate((cached_values, values)),
+                 size, mtime)
+
+    def get_rollup(self, source, name, stat=None):
+        """Return the cached rollup `name' (see rollup.INTERVALS) of
+        `source' or None if it is not cached or stale"""
+        if stat is None:
+            stat = os.stat(source)
+        header = self.__get_rollup_header(source)
+        if not header or name not in header['rollups'] or \
+                header['mtime'] != stat.st_mtime or header['size'] != stat.st_size:
+            return None
+        return np.load(self.__path(source, name + '.npy'))
+
+    def put_rollups(self, source, rollups, size=None, mtime=None):
+        """Store the rollups of `source', a dictionary of name to
+        rollup. `size' and `mtime' are as for put"""
+        if size is None or mtime is None:
+            stat = os.stat(source)
+            size = stat.st_size if size is None else size
+            mtime = stat.st_mtime if mtime is None else mtime
+        header = {'version': self.VERSION, 'mtime': mtime, 'size': size,
+                  'rollups': sorted(rollups)}
+        try:
+            _write_entry(self.directory,
+                         [(self.__path(source, name + '.npy'), rollup) \
+                              for name, rollup in rollups.items()],
+                         self.__path(source, 'rollup.hdr'), header)
+        except (IOError, OSError) as e:
+            log.warn('Could not cache rollups of ' + source + ': ' + str(e))
+
+    def append_rollups(self, source, rollups, offset, size, mtime):
+        """Merge the rollups of the records read from bytes [offset,
+        size) of `source' into its cached rollups. Nothing is stored
+        unless the cached rollups end at `offset'"""
+        header = self.__get_rollup_header(source)
+        if not header or header['size'] != offset:
+            return
+        merged = {}
+        for name, rollup in rollups.items():
+            merged[name] = merge_rollups([np.load(self.__path(source, name + '.npy')), rollup])
+        self.put_rollups(source, merged, size, mtime)
+
+    def __get_rollup_header(self, source):
+        try:
+            header = json.load(open(self.__path(source, 'rollup.hdr'), 'r'))
+        except (IOError, ValueError):
+            return None
+        if header.get('version') != self.VERSION:
+            return None
+        return header
+
+    def __path(self, source, suffix):
+        return os.path.join(self.directory, os.path.basename(source) + '.' + suffix)
+
+
+class TSDBCache(object):
+    """On disk read through cache of TSDB query results.
+
+    The records of every key (metric prefix, metric name and
+    aggregation) are stored as .npy arrays of timestamps and values,
+    along with a JSON header that lists the time intervals [start,
+    stop) the arrays cover. A request only has to fetch the gaps of
+    its range that are not covered yet (see get_gaps and add)."""
+
+    VERSION = 1
+    DEFAULT_DIRECTORY = os.path.join(os.path.expanduser('~'), '.sensordb', 'tsdb')
+    UNSAFE_CHARS = re.compile('[^A-Za-z0-9._-]')
+
+    # Serializes updates of the cached arrays
+    _lock = threading.Lock()
+
+    def __init__(self, directory=DEFAULT_DIRECTORY):
+        self.directory = directory
+
+    def get_gaps(self, key, start_limit, stop_limit):
+        """Returns the (start, stop) intervals within [start_limit,
+        stop_limit) that are not cached, in seconds since epoch"""
+        start, stop = to_epoch(start_limit), to_epoch(stop_limit)
+        gaps = []
+        for interval_start, interval_stop in self.__get_header(key)['intervals']:
+            if interval_stop <= start:
+                continue
+            if interval_start >= stop:
+                break
+            if interval_start > start:
+                gaps.append((start, interval_start))
+            start = interval_stop
+        if start < stop:
+            gaps.append((start, stop))
+        return gaps
+
+    def load(self, key, start_limit, stop_limit):
+        """Returns the cached timestamps and values of `key' within
+        [start_limit, stop_limit)"""
+        timestamps, values = self.__load(key, self.__get_header(key))
+        start_index, stop_index = np.searchsorted(timestamps, [to_epoch(start_limit),
+                                                               to_epoch(stop_limit)])
+        return timestamps[start_index : stop_index], values[start_index : stop_index]
+
+    def add(self, key, start_limit, stop_limit, timestamps, values):
+        """Store the records of `key' fetched for [start_limit,
+        stop_limit), replacing any cached records of the interval.
+        Failure to write the cache is logged and otherwise ignored"""
+        start, stop = to_epoch(start_limit), to_epoch(stop_limit)
+        timestamps = np.asarray(timestamps, dtype=np.int64)
+        values = np.asarray(values, dtype=np.float64)
+        selected = (timestamps >= start) & (timestamps < stop)
+        self._lock.acquire()
+        try:
+            header = self.__get_header(key)
+            cached_timestamps, cached_values = self.__load(key, header)
+            kept = (cached_timestamps < start) | (cached_timestamps >= stop)
+            timestamps = np.concatenate((cached_timestamps[kept], timestamps[selected]))
+            values = np.concatenate((cached_values[kept], values[selected]))
+            order = np.argsort(timestamps, kind='mergesort')
+            timestamps, values = timestamps[order], values[order]
+
+            intervals = []
+            for interval in sorted(header['intervals'] + [[start, stop]]):
+                if intervals and interval[0] <= intervals[-1][1]:
+                    intervals[-1][1] = max(intervals[-1][1], interval[1])
+                else:
+                    intervals.append(list(interval))
+            header = {'version': self.VERSION,
+                      'intervals': intervals,
+                      'count': len(timestamps)}
+            _write_entry(self.directory,
+                         [(self.__path(key, 'ts.npy'), timestamps),
+                          (self.__path(key, 'val.npy'), values)],
+                         self.__path(key, 'hdr'), header)
+        except (IOError, OSError) as e:
+            log.warn('Could not cache ' + str(key) + ': ' + str(e))
+        finally:
+            self._lock.release()
+
+    def __get_header(self, key):
+        try:
+            header = json.load(open(self.__path(key, 'hdr'), 'r'))
+        except (IOError, ValueError):
+            header = None
+        if not header or header.get('version') != self.VERSION:
+            return {'version': self.VERSION, 'intervals': [], 'count': 0}
+        return header
+
+    def __load(self, key, header):
+        if not header['count']:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+        return np.load(self.__path(key, 'ts.npy'), mmap_mode='r'), \
+            np.load(self.__path(key, 'val.npy'), mmap_mode='r')
+
+    def __path(self, key, suffix):
+        name = self.UNSAFE_CHARS.sub('_', '.'.join([str(part) for part in key]))
+        return os.path.join(self.directory, name + '.' + suffix)
+
+
+class DataCache(object):
+    """Memory bounded cache of loaded sensor data, shared by all
+    SensorTraces of the process.
+
+    Data is kept per sensor key along with the time range it was
+    loaded for, so that a query for a sub-range of a cached range is
+    answered without loading anything. When the cached data exceeds
+    `budget' bytes, the least recently used ranges are evicted."""
+
+    DEFAULT_BUDGET = 512 * 1024 * 1024
+
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = {}             # key -> list of entries
+        self.__clock = 0
+        self.__lock = threading.Lock()
+
+    def get(self, key, start_limit=None, stop_limit=None):
+        """Returns a cached DataCollection of `key' that covers
+        [start_limit, stop_limit) or None. The collection may hold
+        more than the requested range"""
+        start, stop = to_epoch(start_limit), to_epoch(stop_limit)
+        self.__lock.acquire()
+        try:
+            for entry in self.__entries.get(key, []):
+                if self.__covers(entry, start, stop):
+                    self.hits += 1
+                    self.__clock += 1
+                    entry['used'] = self.__clock
+                    return entry['data']
+            self.misses += 1
+            return None
+        finally:
+            self.__lock.release()
+
+    def put(self, key, start_limit, stop_limit, data):
+        """Cache the DataCollection `data' of `key' loaded for
+        [start_limit, stop_limit)"""
+        size = len(data) * (np.dtype(np.int64).itemsize + np.dtype(np.float64).itemsize)
+        if size > self.budget:
+            return
+        entry = {'start': to_epoch(start_limit), 'stop': to_epoch(stop_limit),
+                 'data': data, 'size': size}
+        self.__lock.acquire()
+        try:
+            # Ranges within the new one are of no further use
+            entries = self.__entries.setdefault(key, [])
+            for old in [old for old in entries if self.__covers(entry, old['start'], old['stop'])]:
+                self.__remove(key, old)
+            self.__clock += 1
+            entry['used'] = self.__clock
+            entries.append(entry)
+            self.size += size
+            self.__evict()
+        finally:
+            self.__lock.release()
+
+    def extend(self, key, data):
+        """Add the records of the DataCollection `data', newly read
+        for `key', to every cached range of `key' they fall into"""
+        timestamps, values = data.get_epoch_tuples()
+        record_size = np.dtype(np.int64).itemsize + np.dtype(np.float64).itemsize
+        self.__lock.acquire()
+        try:
+            for entry in self.__entries.get(key, []):
+                selected = np.ones(len(timestamps), dtype=bool)
+                if entry['start'] is not None:
+                    selected &= timestamps >= entry['start']
+                if entry['stop'] is not None:
+                    selected &= timestamps < entry['stop']
+                if not selected.any():
+                    continue
+                entry['data'].append_arrays(timestamps[selected], values[selected])
+                size = len(entry['data']) * record_size
+                self.size += size - entry['size']
+                entry['size'] = size
+            self.__evict()
+        finally:
+            self.__lock.release()
+
+    def invalidate(self, key):
+        """Drop all cached data of `key'"""
+        self.__lock.acquire()
+        try:
+            for entry in list(self.__entries.get(key, [])):
+                self.__remove(key, entry)
+        finally:
+            self.__lock.release()
+
+    def clear(self):
+        self.__lock.acquire()
+        try:
+            self.__entries = {}
+            self.size = 0
+        finally:
+            self.__lock.release()
+
+    def set_budget(self, budget):
+        """Change the memory budget, evicting data if required"""
+        self.__lock.acquire()
+        try:
+            self.budget = budget
+            self.__evict()
+        finally:
+            self.__lock.release()
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'size': self.size,
+                'budget': self.budget}
+
+    def __covers(self, entry, start, stop):
+        if entry['start'] is not None and (start is None or start < entry['start']):
+            return False
+        if entry['stop'] is not None and (stop is None or stop > entry['stop']):
+            return False
+        return True
+
+    def __remove(self, key, entry):
+        self.__entries[key].remove(entry)
+        if not self.__entries[key]:
+            del self.__entries[key]
+        self.size -= entry['size']
+
+    def __evict(self):
+        while self.size > self.budget:
+            key, entry = min([(key, entry) for key in self.__entries \
+                                  for entry in self.__entries[key]],
+                             key=lambda item: item[1]['used'])
+            self.__remove(key, entry)
+            self.evictions += 1
+
+
+# Cache of sensor data for the whole process
+DATA_CACHE = DataCache()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Author:  prashmohan@gmail.com
+         http://www.cs.berkeley.edu/~prmohan
+        
+Copyright (c) 2011, University of California at Berkeley
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of University of California, Berkeley nor the
+      names of its contributors may be used to endorse or promote products
+      derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL PRASHANTH MOHAN BE LIABLE FOR ANY
+DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import os
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Catalog(object):
+    """Persistent listing of the sensors in a trace directory.
+
+    For every sensor directory the catalog keeps an entry describing
+    the sensor (its parsed name and its trace files with their months,
+    record counts and time bounds), along with the modification time
+    of the directory. The root directory is only listed again if it
+    changed, and an entry is only rebuilt if its sensor directory
+    changed. The catalog is stored as JSON in the root directory."""
+
+    FILE_NAME = '.catalog.json'
+    VERSION = 1
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, self.FILE_NAME)
+        self.modified = False
+        self.__mtimes = {}
+        try:
+            contents = json.load(open(self.path, 'r'))
+        except (IOError, ValueError):
+            contents = {}
+        if contents.get('version') != self.VERSION:
+            contents = {}
+        self.root_mtime = contents.get('root_mtime')
+        self.sensors = _to_str(contents.get('sensors', {}))
+
+    def get_sensor_names(self):
+        """Returns the names of the sensor directories"""
+        root_mtime = os.stat(self.directory).st_mtime
+        if root_mtime == self.root_mtime:
+            return sorted(self.sensors.keys())
+
+        names = [name for name in os.listdir(self.directory) \
+                     if not name.startswith('.') and \
+                     os.path.isdir(os.path.join(self.directory, name))]
+        for name in set(self.sensors.keys()) - set(names):
+            del self.sensors[name]
+        self.root_mtime = root_mtime
+        self.modified = True
+        return sorted(names)
+
+    def get_entry(self, sensor_name):
+        """Returns the entry of `sensor_name' or None if there is no
+        entry or the sensor directory changed since it was made"""
+        mtime = os.stat(os.path.join(self.directory, sensor_name)).st_mtime
+        self.__mtimes[sensor_name] = mtime
+        entry = self.sensors.get(sensor_name)
+        if entry and entry.get('mtime') == mtime:
+            return entry
+        return None
+
+    def put_entry(self, sensor_name, entry):
+        """Store the entry of `sensor_name'. The entry should describe
+        the directory as it was when get_entry was called"""
+        entry['mtime'] = self.__mtimes.get(sensor_name)
+        self.sensors[sensor_name] = entry
+        self.modified = True
+
+    def save(self):
+        """Write the catalog if it was modified. Failure to write the
+        catalog is logged and otherwise ignored"""
+        if not self.modified:
+            return
+        try:
+            if not os.path.exists(self.path):
+                # Creating the file changes the root directory. The
+                # file is rewritten in place afterwards, which does not.
+                open(self.path, 'w').close()
+                self.root_mtime = os.stat(self.directory).st_mtime
+            contents = {'version': self.VERSION,
+                        'root_mtime': self.root_mtime,
+                        'sensors': self.sensors}
+            f = open(self.path, 'w')
+            try:
+                json.dump(contents, f)
+            finally:
+                f.close()
+            self.modified = False
+        except (IOError, OSError) as e:
+            log.warn('Could not save catalog ' + self.path + ': ' + str(e))
+
+
+def _to_str(value):
+    """Convert the unicode strings read by json back into the byte
+    strings that names and paths are kept as"""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, dict):
+        return dict([(_to_str(key), _to_str(item)) for key, item in value.items()])
+    if isinstance(value, list):
+        return [_to_str(item) for item in value]
+    return value
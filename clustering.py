@@ -32,9 +32,9 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 from pylab import *
 from scipy.cluster.vq import vq, kmeans2, whiten
 import scipy.spatial.distance as dist
-import scipy.interpolate
-from time import mktime
 import types
+import numpy as np
+from common import local_to_utc
 try:
     import fastcluster as hier
 except:
@@ -42,6 +42,9 @@ except:
 
 COLORS = ['b', 'g', 'r', 'c', 'm', 'y', 'k']
 
+# Resampling methods of align
+ALIGN_METHODS = ('linear', 'previous', 'mean')
+
 def get_clean(data):
     return [x for x in data if not isnan(x)]
 
@@ -72,28 +75,20 @@ def plot_data(data, buckets=5):
                  color=color, marker='o', linestyle='None')
 
 def get_data(data, normalize=True):
-    ts = array(map(conv_time, data.get_data().get_ts()))
+    # UNIX timestamps, which unlike the local wall clock time of the
+    # trace do not jump at daylight saving time changes
+    ts = local_to_utc(data.get_data().get_epochs())
     if normalize:
         return ts - min(ts), data.get_data().get_data()
     else:
         return ts, data.get_data().get_data()
 
-def get_multid_data(data):
-    data_data = [get_data(d) for d in data]
-    x_vals, y_vals = interpolate(data_data, sampling_freq=3600)
-    out_data = y_vals
-    ret_data = []
-
-    for index in range(len(out_data[0])):
-        found_nan = False
-        for x in out_data:
-            if isnan(x[index]):
-                found_nan = True
-                break
-        if found_nan:
-            continue
-        ret_data.append([x[index] for x in out_data])
-    return ret_data
+def get_multid_data(data, sampling_freq=3600, method='linear'):
+    """Align the traces in `data' (see align) and return the (time x
+    sensors) array of the grid points where every trace has a value"""
+    grid, matrix = align([get_data(d, normalize=False) for d in data],
+                         sampling_freq, method)
+    return matrix[~np.isnan(matrix).any(axis=1)]
 
 def hier_cluster(data):
     if type(data) != types.ListType and type(data) != type(array([])):
@@ -105,21 +100,41 @@ def hier_cluster(data):
     return fastcluster.linkage(d, method='centroid')
 
 def interpolate(signals, sampling_freq=1):
-    start_time = min(signals[0][0])
-    stop_time = max(signals[0][0])
-    interpols = []
-    
-    for signal in signals:
-        start_time = max(start_time, min(signal[0]))
-        stop_time = min(stop_time, max(signal[0]))
-        interpols.append(scipy.interpolate.interp1d(signal[0], signal[1]))
-
-    x_new = range(start_time, stop_time, sampling_freq)
-    y_vals = []
-    for interpolator in interpols:
-        y_vals.append(interpolator(x_new))
-
-    return x_new, y_vals
-
-def conv_time(dt):
-    return mktime(dt.timetuple())
+    x_new, matrix = align(signals, sampling_freq)
+    return x_new, list(matrix.T)
+
+def align(signals, sampling_freq=1, method='linear'):
+    """Resample `signals', a list of time ordered (timestamps, values)
+    pairs, onto a common grid of `sampling_freq' seconds over the time
+    all signals overlap. `method' is one of ALIGN_METHODS: linear
+    interpolation, the previous value or the mean of the values within
+    each grid interval.
+
+    Returns the grid and a (time x sensors) array of the resampled
+    values, which are NaN where a signal has no value"""
+    if method not in ALIGN_METHODS:
+        raise ValueError("Unknown alignment method: " + str(method))
+    signals = [(np.asarray(ts, dtype=np.int64), np.asarray(values, dtype=np.float64)) \
+                   for ts, values in signals]
+    if not signals or not all(len(ts) for ts, values in signals):
+        return np.empty(0, dtype=np.int64), np.empty((0, len(signals)))
+    start_time = max([ts[0] for ts, values in signals])
+    stop_time = min([ts[-1] for ts, values in signals])
+    grid = np.arange(start_time, max(start_time, stop_time), sampling_freq)
+    matrix = np.empty((len(grid), len(signals)))
+    if not len(grid):
+        return grid, matrix
+
+    for column, (ts, values) in enumerate(signals):
+        if method == 'linear':
+            matrix[:, column] = np.interp(grid, ts, values)
+        elif method == 'previous':
+            matrix[:, column] = values[np.searchsorted(ts, grid, 'right') - 1]
+        else:
+            index = (ts - start_time) // sampling_freq
+            selected = (index >= 0) & (index < len(grid)) & ~np.isnan(values)
+            index = index[selected]
+            count = np.bincount(index, minlength=len(grid))
+            sums = np.bincount(index, weights=values[selected], minlength=len(grid))
+            matrix[:, column] = np.where(count > 0, sums / np.maximum(count, 1), np.nan)
+    return grid, matrix
@@ -33,6 +33,7 @@ import sys
 import os
 import time
 import datetime
+import calendar
 import logging
 import types
 import string
@@ -53,6 +54,212 @@ SENSOR_TYPES = {
     'OAT' : 'Outside Air Temperature',
     'ROOM' : 'Room'
     }
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def to_epoch(dt):
+    """Convert a datetime object into the number of seconds since
+    epoch. Timestamps are kept in the same wall clock time that the
+    datetime objects of the trace are in. Integers are passed through."""
+    if dt is None:
+        return None
+    if isinstance(dt, datetime.datetime):
+        delta = dt - EPOCH
+        return delta.days * 86400 + delta.seconds
+    return int(dt)
+
+
+def from_epoch(seconds):
+    """Convert the number of seconds since epoch into a datetime object"""
+    return EPOCH + datetime.timedelta(seconds=int(seconds))
+
+
+def to_epoch_array(timestamps):
+    """Convert a sequence of datetime objects, datetime64 values or
+    integers into an int64 array of seconds since epoch"""
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind == 'O':
+        timestamps = timestamps.astype('M8[s]')
+    if timestamps.dtype.kind == 'M':
+        timestamps = timestamps.astype('M8[s]').view(np.int64)
+    return timestamps.astype(np.int64, copy=False)
+
+
+def utc_to_local(timestamps):
+    """Convert an array of UNIX timestamps into seconds since epoch in
+    the local wall clock time. The UTC offset is looked up once for
+    every day of the time span, and for every hour of the days the
+    offset changes on"""
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    if not len(timestamps):
+        return timestamps
+    hours = timestamps // 3600
+    first_day = int(hours.min()) // 24
+    days = np.arange(first_day, int(hours.max()) // 24 + 2)
+    day_offsets = np.array([_get_utc_offset(int(day) * 86400) for day in days],
+                           dtype=np.int64)
+    hour_offsets = np.repeat(day_offsets[:-1], 24)
+    for index in np.flatnonzero(day_offsets[1:] != day_offsets[:-1]):
+        for hour in range(24):
+            hour_offsets[index * 24 + hour] = \
+                _get_utc_offset((int(days[index]) * 24 + hour) * 3600)
+    return timestamps + hour_offsets[hours - first_day * 24]
+
+
+def _get_utc_offset(timestamp):
+    return calendar.timegm(time.localtime(timestamp)) - timestamp
+
+
+def local_to_utc(dt):
+    """Convert a datetime object (or seconds since epoch in the local
+    wall clock time) into a UNIX timestamp. An array of datetime64
+    values or seconds since epoch is converted as a whole into an
+    int64 array, using the offsets of utc_to_local"""
+    if np.ndim(dt):
+        local = to_epoch_array(dt)
+        # The offset at the local time taken as UTC is off by at most
+        # the change of the offset in between, which the offset at
+        # the first estimate makes up for
+        timestamps = local - (utc_to_local(local) - local)
+        return local - (utc_to_local(timestamps) - timestamps)
+    if not isinstance(dt, datetime.datetime):
+        dt = from_epoch(dt)
+    return int(time.mktime(dt.timetuple()))
+
+
+def read_only(array):
+    """Return a read only view of `array'"""
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+# Up to this many blocks, merge_sorted copies slices instead of
+# scattering single records
+MERGE_BLOCKS = 64
+
+
+def count_fields(text, separator=None):
+    """Returns the number of fields on every line of `text' as an
+    array. Fields are separated by `separator' or, if it is None, by
+    runs of whitespace as with str.split"""
+    chars = np.frombuffer(text, dtype=np.uint8)
+    newlines = chars == ord('\n')
+    if separator is None:
+        blank = newlines | (chars == ord(' ')) | (chars == ord('\t')) | \
+            (chars == ord('\r'))
+        marks = ~blank
+        marks[1:] &= blank[:-1]
+    else:
+        marks = chars == ord(separator)
+    # Positions of the marks and line ends, in order. Every line holds
+    # the marks between two line ends.
+    positions = np.flatnonzero(marks | newlines)
+    ends = np.flatnonzero(newlines[positions])
+    counts = np.diff(np.concatenate(([-1], ends, [len(positions)]))) - 1
+    if separator is None:
+        return counts
+    return counts + 1
+
+
+def parse_numbers(fields, dtype):
+    """Convert a list of numeric strings into an array of `dtype'"""
+    numbers = np.fromstring(' '.join(fields), dtype=dtype, sep=' ')
+    if len(numbers) != len(fields):
+        # Let NumPy point out the offending field
+        numbers = np.array(fields).astype(dtype)
+    return numbers
+
+
+def get_trace_date(file_name):
+    """Returns the month of a trace file from its name, e.g.
+    SODA4R410__ART$201003H.DAT.csv"""
+    date_str = file_name[file_name.rfind('$') + 1 : file_name.rfind('H')]
+    return datetime.datetime(int(date_str[:4]), int(date_str[-2:]), 1)
+
+
+# Downsample specs as understood by OpenTSDB, e.g. 1h-avg or 15m-max
+DOWNSAMPLE_SPEC = re.compile('^(\d+)([smhdw])-(avg|sum|min|max|dev)$')
+DOWNSAMPLE_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+def parse_downsample(spec):
+    """Returns the interval in seconds and the aggregator of a
+    downsample spec such as 1h-avg"""
+    match = DOWNSAMPLE_SPEC.match(spec)
+    if not match:
+        raise ValueError("Invalid downsample spec: " + spec)
+    return int(match.group(1)) * DOWNSAMPLE_UNITS[match.group(2)], match.group(3)
+
+
+def downsample(timestamps, values, spec):
+    """Aggregate time ordered records into the intervals of the
+    downsample `spec'. Returns the start of every non empty interval
+    (seconds since epoch) and the aggregated values"""
+    interval, aggregator = parse_downsample(spec)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if not len(timestamps):
+        return timestamps, values
+    buckets = timestamps // interval
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    if aggregator == 'min':
+        result = np.minimum.reduceat(values, starts)
+    elif aggregator == 'max':
+        result = np.maximum.reduceat(values, starts)
+    else:
+        result = np.add.reduceat(values, starts)
+        if aggregator != 'sum':
+            counts = np.diff(np.append(starts, len(values)))
+            result = result / counts
+            if aggregator == 'dev':
+                squares = np.add.reduceat(values * values, starts) / counts
+                result = np.sqrt(np.maximum(squares - result * result, 0))
+    return buckets[starts] * interval, result
+
+
+def get_next_month(date):
+    """Returns the start of the month following `date'"""
+    if date.month == 12:
+        return datetime.datetime(date.year + 1, 1, 1)
+    return datetime.datetime(date.year, date.month + 1, 1)
+
+
+def merge_sorted(ts_a, data_a, ts_b, data_b):
+    """Merge two sorted runs of timestamps and their values in linear
+    time. Records of the second run are placed after records of the
+    first run with the same timestamp"""
+    if not len(ts_a) or not len(ts_b) or ts_a[-1] <= ts_b[0]:
+        return np.concatenate((ts_a, ts_b)), np.concatenate((data_a, data_b))
+    if ts_b[-1] < ts_a[0]:
+        return np.concatenate((ts_b, ts_a)), np.concatenate((data_b, data_a))
+
+    insert_at = np.searchsorted(ts_a, ts_b, 'right')
+    # Records of the second run that go to the same place form blocks
+    breaks = np.flatnonzero(insert_at[1:] != insert_at[:-1]) + 1
+    if len(breaks) < MERGE_BLOCKS:
+        # Few blocks, e.g. when a month fills a gap in the first run.
+        # Stitch the slices together.
+        ts_pieces, data_pieces = [], []
+        previous = 0
+        for start, stop in zip([0] + list(breaks), list(breaks) + [len(ts_b)]):
+            position = insert_at[start]
+            ts_pieces.extend((ts_a[previous : position], ts_b[start : stop]))
+            data_pieces.extend((data_a[previous : position], data_b[start : stop]))
+            previous = position
+        ts_pieces.append(ts_a[previous:])
+        data_pieces.append(data_a[previous:])
+        return np.concatenate(ts_pieces), np.concatenate(data_pieces)
+
+    from_b = np.zeros(len(ts_a) + len(ts_b), dtype=bool)
+    from_b[insert_at + np.arange(len(ts_b))] = True
+    timestamps = np.empty(len(from_b), dtype=np.int64)
+    data = np.empty(len(from_b), dtype=np.float64)
+    timestamps[from_b], timestamps[~from_b] = ts_b, ts_a
+    data[from_b], data[~from_b] = data_b, data_a
+    return timestamps, data
+
+
 class DataRecord(object):
     """Python representation for each individual record in the Trace"""
     
@@ -66,6 +273,14 @@ class DataRecord(object):
             
         self.data = float(data.strip())
 
+    @classmethod
+    def from_values(cls, ts, data):
+        """Build a record from a datetime object and a float"""
+        record = cls.__new__(cls)
+        record.ts = ts
+        record.data = float(data)
+        return record
+
     def __cmp__(self, other):
         if self.ts < other.ts:
             return -1
@@ -83,25 +298,117 @@ class DataRecord(object):
 
 class DataCollection(object):
     """Python representation of a set of records. Typically a trace
-    file or a part of a trace"""
+    file or a part of a trace.
+
+    The records are stored column wise, as an int64 array of seconds
+    since epoch and a float64 array of values. Both arrays grow
+    geometrically so that appending is amortized constant time.
+
+    Every appended chunk is kept as a sorted run. When the collection
+    is accessed, runs that do not overlap are simply put in order and
+    overlapping runs are merged, instead of sorting all records."""
+
+    INITIAL_CAPACITY = 1024
+    # Beyond this many runs a full sort is cheaper than merging
+    MAX_MERGE_RUNS = 64
     
-    def __init__(self, start_limit=None, stop_limit=None):
+    def __init__(self, start_limit=None, stop_limit=None, unique=False):
         """start_limit and stop_limit are optional arguments that
-        describe the subsection of the trace to operate on."""
-        self.records = []
+        describe the subsection of the trace to operate on. If
+        `unique' is set, records that occur more than once (same
+        timestamp and value), e.g. from overlapping trace files, are
+        only kept once."""
         self.start_limit = start_limit
         self.stop_limit = stop_limit
+        self.unique = unique
         self.sorted = True
+        self._ts = np.empty(0, dtype=np.int64)
+        self._data = np.empty(0, dtype=np.float64)
+        self._size = 0
+        self._runs = []
+        self._checked_size = 0
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def records(self):
+        """The collection as a list of DataRecord objects. This is
+        only kept for compatibility, as it builds one object per
+        sample"""
+        self.__sort()
+        return [DataRecord.from_values(from_epoch(ts), data) \
+                    for ts, data in zip(self._ts[:self._size],
+                                        self._data[:self._size])]
 
     def append(self, record):
         """Add a record or a list of records to the collection"""
         if type(record) == types.ListType:
-            self.__extend(record)
-        elif type(record) == type(self):
-            self.__extend(record.records)
+            self.append_arrays([to_epoch(rec.ts) for rec in record],
+                               [rec.data for rec in record])
+        elif isinstance(record, DataCollection):
+            record.__sort()
+            self.append_arrays(record._ts[:record._size],
+                               record._data[:record._size])
         else:
-            self.records.append(record)
-        self.sorted = False
+            self.append_arrays([to_epoch(record.ts)], [record.data])
+
+    def append_arrays(self, timestamps, data):
+        """Add records given as an array of timestamps (seconds since
+        epoch, datetime64 or datetime objects) and an array of
+        values"""
+        timestamps = to_epoch_array(timestamps)
+        data = np.asarray(data, dtype=np.float64)
+        if len(timestamps) != len(data):
+            raise ValueError("Timestamps and data differ in length")
+        count = len(timestamps)
+        if count == 0:
+            return
+        if count > 1 and np.any(timestamps[1:] < timestamps[:-1]):
+            order = np.argsort(timestamps, kind='mergesort')
+            timestamps, data = timestamps[order], data[order]
+
+        if self._runs and timestamps[0] >= self._ts[self._size - 1]:
+            # The chunk continues the last run
+            self._runs[-1][1] += count
+        else:
+            self._runs.append([self._size, self._size + count])
+        self.sorted = len(self._runs) <= 1
+            
+        self.__reserve(count)
+        self._ts[self._size : self._size + count] = timestamps
+        self._data[self._size : self._size + count] = data
+        self._size += count
+
+    def remove_duplicates(self):
+        """Drop records that have the same timestamp and value as
+        another record of the collection"""
+        self.__sort()
+        self.__remove_duplicates()
+
+    def __remove_duplicates(self):
+        timestamps = self._ts[:self._size]
+        data = self._data[:self._size]
+        same_ts = timestamps[1:] == timestamps[:-1]
+        if not same_ts.any():
+            self._checked_size = self._size
+            return
+
+        # Order the values of records sharing a timestamp, so that
+        # duplicates are next to each other
+        shared = np.zeros(self._size, dtype=bool)
+        shared[1:] |= same_ts
+        shared[:-1] |= same_ts
+        shared = np.flatnonzero(shared)
+        data = data.copy()
+        data[shared] = data[shared][np.lexsort((data[shared], timestamps[shared]))]
+
+        keep = np.ones(self._size, dtype=bool)
+        keep[1:] = ~same_ts | (data[1:] != data[:-1])
+        self._ts, self._data = timestamps[keep], data[keep]
+        self._size = len(self._ts)
+        self._runs = [[0, self._size]]
+        self._checked_size = self._size
 
     def get_data_tuples(self, start_limit=None, stop_limit=None):
         """Retrieve data and timestamps from the data collection.
@@ -109,12 +416,21 @@ class DataCollection(object):
         start_limit and stop_limit are optional arguments that
         describe the subsection of the trace to operate on. If these
         options are not provided, then any arguments provided on
-        object intialization will be used."""
+        object intialization will be used. The timestamps are a
+        datetime64 view on the collection."""
 
         start_index, stop_index = self.__get_start_stop_indexes(start_limit, stop_limit)
-        return np.array([rec.ts for rec in self.records[start_index : stop_index]]), \
-            np.array([rec.data for rec in self.records[start_index : stop_index]])
-            
+        return self.__get_datetimes(start_index, stop_index), \
+            read_only(self._data[start_index : stop_index])
+
+    def get_epoch_tuples(self, start_limit=None, stop_limit=None):
+        """Same as get_data_tuples, except that the timestamps are
+        returned as seconds since epoch. Both arrays are read only
+        views on the collection"""
+
+        start_index, stop_index = self.__get_start_stop_indexes(start_limit, stop_limit)
+        return read_only(self._ts[start_index : stop_index]), \
+            read_only(self._data[start_index : stop_index])
 
     def get_data(self, start_limit=None, stop_limit=None):
         """Retrieve data from the data collection.
@@ -125,10 +441,11 @@ class DataCollection(object):
         object intialization will be used."""
 
         start_index, stop_index = self.__get_start_stop_indexes(start_limit, stop_limit)
-        return np.array([rec.data for rec in self.records[start_index : stop_index]])
+        return read_only(self._data[start_index : stop_index])
 
     def get_ts(self, start_limit=None, stop_limit=None):
-        """Retrieve timestamps from the data collection.
+        """Retrieve timestamps from the data collection as datetime64
+        values.
 
         start_limit and stop_limit are optional arguments that
         describe the subsection of the trace to operate on. If these
@@ -136,15 +453,30 @@ class DataCollection(object):
         object intialization will be used."""
         
         start_index, stop_index = self.__get_start_stop_indexes(start_limit, stop_limit)
-        return np.array([rec.ts for rec in self.records[start_index : stop_index]])
+        return self.__get_datetimes(start_index, stop_index)
+
+    def get_epochs(self, start_limit=None, stop_limit=None):
+        """Retrieve timestamps as seconds since epoch from the data
+        collection"""
+        
+        start_index, stop_index = self.__get_start_stop_indexes(start_limit, stop_limit)
+        return read_only(self._ts[start_index : stop_index])
 
     def get_length(self):
         """Returns the length of the trace as a timedelta object"""
         self.__sort()
-        if not self.records:
+        if not self._size:
             return 0
-        return self.records.ts[-1] - self.records.ts[0]
+        return datetime.timedelta(seconds=int(self._ts[self._size - 1] - self._ts[0]))
         
+    def get_downsampled(self, spec, start_limit=None, stop_limit=None):
+        """Returns a new DataCollection of the records aggregated into
+        the intervals of the downsample `spec' (see downsample)"""
+        data = DataCollection(self.start_limit, self.stop_limit)
+        timestamps, values = self.get_epoch_tuples(start_limit, stop_limit)
+        data.append_arrays(*downsample(timestamps, values, spec))
+        return data
+
     def __get_start_stop_indexes(self, start_limit, stop_limit):
         self.__sort()
         if not start_limit:
@@ -152,23 +484,88 @@ class DataCollection(object):
         if not stop_limit:
             stop_limit = self.stop_limit
 
+        # The timestamps are sorted, so the limits can be found by a
+        # binary search
+        timestamps = self._ts[:self._size]
         start_index = 0
-        stop_index = len(self.records)
-        for index, record in enumerate(self.records):
-            if start_limit and record.ts < start_limit:
-                start_index = index
-            if stop_limit and record.ts < stop_limit:
-                stop_limit = index
-
-        return start_index, stop_index                
+        stop_index = self._size
+        if start_limit:
+            start_index = int(np.searchsorted(timestamps, to_epoch(start_limit), 'left'))
+        if stop_limit:
+            stop_index = int(np.searchsorted(timestamps, to_epoch(stop_limit), 'left'))
+
+        return start_index, max(start_index, stop_index)
+
+    def __get_datetimes(self, start_index, stop_index):
+        return read_only(self._ts[start_index : stop_index]).view('M8[s]')
         
-    def __extend(self, records):
-        self.records.extend(records)
+    def __reserve(self, count):
+        capacity = len(self._ts)
+        if self._size + count <= capacity:
+            return
+        capacity = max(self._size + count, 2 * capacity, self.INITIAL_CAPACITY)
+        ts = np.empty(capacity, dtype=np.int64)
+        data = np.empty(capacity, dtype=np.float64)
+        ts[:self._size] = self._ts[:self._size]
+        data[:self._size] = self._data[:self._size]
+        self._ts, self._data = ts, data
 
     def __sort(self):
         if not self.sorted:
-            self.records.sort()
+            if len(self._runs) > self.MAX_MERGE_RUNS:
+                order = np.argsort(self._ts[:self._size], kind='mergesort')
+                self._ts = self._ts[:self._size][order]
+                self._data = self._data[:self._size][order]
+            else:
+                self.__merge_runs()
+            self._runs = [[0, self._size]]
         self.sorted = True
+        if self.unique and self._checked_size != self._size:
+            self.__remove_duplicates()
+
+    def __merge_runs(self):
+        runs = sorted(self._runs, key=lambda run: self._ts[run[0]])
+        # Disjoint sorted chunks of the result, in order
+        chunks = []
+        for start, stop in runs:
+            timestamps, data = self._ts[start : stop], self._data[start : stop]
+            overlapping = []
+            following = []
+            while chunks and chunks[-1][0][-1] > timestamps[0]:
+                chunk = chunks.pop()
+                if chunk[0][0] > timestamps[-1]:
+                    following.insert(0, chunk)
+                else:
+                    overlapping.insert(0, chunk)
+            if not overlapping:
+                chunks.append((timestamps, data))
+                chunks.extend(following)
+                continue
+
+            # Only the records within the time span of the run need to
+            # be merged
+            if len(overlapping) == 1:
+                ts_a, data_a = overlapping[0]
+            else:
+                ts_a = np.concatenate([chunk[0] for chunk in overlapping])
+                data_a = np.concatenate([chunk[1] for chunk in overlapping])
+            first = np.searchsorted(ts_a, timestamps[0], 'right')
+            last = np.searchsorted(ts_a, timestamps[-1], 'right')
+            if first:
+                chunks.append((ts_a[:first], data_a[:first]))
+            if first == last:
+                chunks.append((timestamps, data))
+            else:
+                chunks.append(merge_sorted(ts_a[first : last], data_a[first : last],
+                                           timestamps, data))
+            if last < len(ts_a):
+                chunks.append((ts_a[last:], data_a[last:]))
+            chunks.extend(following)
+        self._ts = np.concatenate([chunk[0] for chunk in chunks])
+        self._data = np.concatenate([chunk[1] for chunk in chunks])
+
+
+ROOM_SENSOR = re.compile('^SODA\dR.*_+(ASO|ART|ARS|AGN|VAV|RVAV)$')
 
 
 class Name(object):
@@ -189,6 +586,25 @@ class Name(object):
             index += 1
         self.type = self.name[start_index + index : ]
         self.prefix = self.name[ : self.name.find('R')]
+
+    @classmethod
+    def from_fields(cls, name, fields):
+        """Build a Name from the dictionary returned by get_fields
+        without parsing `name' again"""
+        parsed = cls.__new__(cls)
+        parsed.name = name
+        parsed.room_no = fields['room_no']
+        parsed.floor = fields['floor']
+        parsed.type = fields['type']
+        parsed.prefix = fields['prefix']
+        return parsed
+
+    def get_fields(self):
+        """Returns the parsed parts of the name as a dictionary"""
+        return {'room_no': self.room_no,
+                'floor': self.floor,
+                'type': self.type,
+                'prefix': self.prefix}
         
     def __repr__(self):
         if not self.is_room():
@@ -209,7 +625,7 @@ class Name(object):
         return repr(self)
 
     def is_room(self):
-        return re.match('^SODA\dR.*_+(ASO|ART|ARS|AGN|VAV|RVAV)$', self.name)
+        return ROOM_SENSOR.match(self.name)
 
     def is_in_room(self, room):
         target = '^SODA\dR' + room + '_+(ASO|ART|ARS|AGN|VAV|RVAV)$'
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+Author:  prashmohan@gmail.com
+         http://www.cs.berkeley.edu/~prmohan
+        
+Copyright (c) 2011, University of California at Berkeley
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of University of California, Berkeley nor the
+      names of its contributors may be used to endorse or promote products
+      derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL PRASHANTH MOHAN BE LIABLE FOR ANY
+DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+# Stand-in for an OpenTSDB server, serving synthetic sensor data over
+# the /suggest and /q (ascii) endpoints used by TSDBTrace. Allows
+# running and benchmarking the TSDB code paths offline:
+#
+#     python fake_tsdb.py [port]
+#
+# and then TSTrace('localhost:4242').
+
+import sys
+import json
+import time
+import random
+import calendar
+# Imported up front, as the lazy import of strptime is not thread safe
+import _strptime
+import datetime
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+import numpy as np
+from common import downsample
+
+TIME_FORMAT = '%Y/%m/%d-%H:%M:%S'
+
+
+class FakeTSDBHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections alive like OpenTSDB does
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.count_request(self)
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            return self.reply(503, 'Service Unavailable', '')
+
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        if url.path == '/suggest':
+            prefix = query.get('q', [''])[0]
+            return self.reply(200, 'OK', json.dumps([metric for metric in server.metrics \
+                                                         if metric.startswith(prefix)]))
+        if url.path == '/q':
+            try:
+                start = parse_time(query['start'][0])
+                stop = parse_time(query['end'][0]) if 'end' in query else int(time.time())
+                specs = [spec.split(':') for spec in query['m']]
+                metrics = [spec[-1] for spec in specs]
+                # Downsampling is given as in avg:1h-avg:metric
+                downsamples = [spec[1] if len(spec) > 2 else None for spec in specs]
+            except (KeyError, ValueError) as e:
+                return self.reply(400, 'Bad Request', str(e))
+            unknown = [metric for metric in metrics if metric not in server.metrics]
+            if unknown:
+                return self.reply(400, 'No such name', 'No such name for metrics: ' + unknown[0])
+            try:
+                return self.reply(200, 'OK', ''.join([server.get_points(metric, start, stop, spec) \
+                                                          for metric, spec in zip(metrics, downsamples)]))
+            except ValueError as e:
+                return self.reply(400, 'Bad Request', str(e))
+        self.reply(404, 'Not Found', '')
+
+    def reply(self, status, reason, body):
+        self.send_response(status, reason)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTSDB(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """OpenTSDB stand-in serving `metrics' with a point every
+    `interval' seconds. Every request is delayed by `latency' seconds
+    and fails with a 503 with probability `error_rate'. The number of
+    connections and requests served is counted"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=4242, metrics=None, interval=60, latency=0, error_rate=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('localhost', port), FakeTSDBHandler)
+        if metrics is None:
+            metrics = ['SCADA.SODA.SODA4R%d__ART' % room for room in range(400, 450)]
+        self.metrics = metrics
+        self.interval = interval
+        self.latency = latency
+        self.error_rate = error_rate
+        self.connections = 0
+        self.requests = 0
+        self.__clients = set()
+        self.__lock = threading.Lock()
+
+    def count_request(self, handler):
+        self.__lock.acquire()
+        try:
+            self.requests += 1
+            if handler.connection not in self.__clients:
+                self.__clients.add(handler.connection)
+                self.connections += 1
+        finally:
+            self.__lock.release()
+
+    def get_points(self, metric, start, stop, spec=None):
+        """Returns the ascii response lines of `metric' within [start,
+        stop], downsampled according to `spec'"""
+        first = start + (-start % self.interval)
+        timestamps = np.arange(first, stop + 1, self.interval, dtype=np.int64)
+        values = 70 + 5 * np.sin((timestamps + hash(metric) % 1000) / 3600.0)
+        values = np.round(values, 2)
+        if spec:
+            timestamps, values = downsample(timestamps, values, spec)
+        return ''.join(['%s %d %.2f host=soda\n' % (metric, timestamp, value) \
+                            for timestamp, value in zip(timestamps, values)])
+
+    def start(self):
+        """Serve requests from a background thread"""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def parse_time(value):
+    # Either a UNIX timestamp or a time in TIME_FORMAT, taken as UTC
+    if value.isdigit():
+        return int(value)
+    return calendar.timegm(datetime.datetime.strptime(value, TIME_FORMAT).timetuple())
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 4242
+    print 'Serving fake OpenTSDB on localhost:%d' % port
+    FakeTSDB(port).serve_forever()
@@ -37,7 +37,7 @@ def get_anomolies(start_limit, stop_limit, limit_percentile=0.95, dist_threshold
     trace = SodaTrace('UCProject_UCB_SODAHALL', start_limit, stop_limit)
     if len(trace.traces[-1].get_data().get_data()) == 0:
         raise Exception("No more data")
-    art4 = [art for art in trace.traces if art.get_name().name.endswith('ART') and art.get_name().name.find('R4') != -1 and art.get_name().name != 'SODA1R438__ART']
+    art4 = [art for art in trace.find_traces('*R4*ART') if art.name != 'SODA1R438__ART']
     multid_data, clust = clustering.hier_cluster(art4)
     percentile = sort(clust[:,2])
     percentile = percentile[int(len(percentile) * limit_percentile)]
@@ -167,7 +167,8 @@ def enum(data):
 def get_chiler_traces(trace):
     temp_sensors = ['SODC1C1____SWT', 'SODC1C1__CDRWT', 'SODC1C2____SWT', 'SODC1C2__CDRWT', 'SODC1S_____SWT', 'SODC1S_____RWT', 'SODC2______SWT', 'SODC1C2____SWS']
     kw_sensors = ['SODC1C1_____KW', 'SODC1C2_____KW']
-    return [t for t in trace.traces if t.get_name().name in temp_sensors], [t for t in trace.traces if t.get_name().name in kw_sensors]
+    return [trace.get_trace(name) for name in temp_sensors if trace.get_trace(name)], \
+        [trace.get_trace(name) for name in kw_sensors if trace.get_trace(name)]
 
     
 def get_clean(data):
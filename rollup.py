@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Author:  prashmohan@gmail.com
+         http://www.cs.berkeley.edu/~prmohan
+        
+Copyright (c) 2011, University of California at Berkeley
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of University of California, Berkeley nor the
+      names of its contributors may be used to endorse or promote products
+      derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL PRASHANTH MOHAN BE LIABLE FOR ANY
+DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import numpy as np
+from common import to_epoch
+
+# One row per interval: the start of the interval (seconds since
+# epoch) and the aggregates of the records within it
+ROLLUP = np.dtype([('time', '<i8'),
+                   ('count', '<i8'),
+                   ('sum', '<f8'),
+                   ('sumsq', '<f8'),
+                   ('min', '<f8'),
+                   ('max', '<f8'),
+                   ('first', '<f8'),
+                   ('last', '<f8')])
+
+# The materialized rollups and their interval in seconds
+INTERVALS = {'hourly': 3600, 'daily': 86400}
+
+
+def build_rollup(timestamps, values, interval):
+    """Aggregate time ordered records into rows of ROLLUP, one for
+    every `interval' seconds that holds records. NaN values are left
+    out"""
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    if not valid.all():
+        timestamps, values = timestamps[valid], values[valid]
+    if not len(timestamps):
+        return np.empty(0, dtype=ROLLUP)
+    buckets = timestamps // interval
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    stops = np.append(starts[1:], len(values))
+    rollup = np.empty(len(starts), dtype=ROLLUP)
+    rollup['time'] = buckets[starts] * interval
+    rollup['count'] = stops - starts
+    rollup['sum'] = np.add.reduceat(values, starts)
+    rollup['sumsq'] = np.add.reduceat(values * values, starts)
+    rollup['min'] = np.minimum.reduceat(values, starts)
+    rollup['max'] = np.maximum.reduceat(values, starts)
+    rollup['first'] = values[starts]
+    rollup['last'] = values[stops - 1]
+    if (buckets[1:] < buckets[:-1]).any():
+        # Out of order records leave several rows per interval
+        rollup = merge_rollups([rollup])
+    return rollup
+
+
+def build_rollups(timestamps, values):
+    """Returns all materialized rollups (see INTERVALS) of time
+    ordered records"""
+    return dict([(name, build_rollup(timestamps, values, interval)) \
+                     for name, interval in INTERVALS.items()])
+
+
+def merge_rollups(rollups):
+    """Combine a time ordered sequence of rollups of the same
+    interval. Rows of the same interval are merged into one, the
+    first value coming from the earliest and the last value from the
+    latest rollup"""
+    rollup = np.concatenate([np.asarray(part, dtype=ROLLUP) for part in rollups] + \
+                                [np.empty(0, dtype=ROLLUP)])
+    if len(rollup) < 2:
+        return rollup
+    rollup = rollup[np.argsort(rollup['time'], kind='mergesort')]
+    times = rollup['time']
+    starts = np.flatnonzero(np.concatenate(([True], times[1:] != times[:-1])))
+    if len(starts) == len(rollup):
+        return rollup
+    stops = np.append(starts[1:], len(rollup))
+    merged = np.empty(len(starts), dtype=ROLLUP)
+    merged['time'] = times[starts]
+    for field in ('count', 'sum', 'sumsq'):
+        merged[field] = np.add.reduceat(rollup[field], starts)
+    merged['min'] = np.minimum.reduceat(rollup['min'], starts)
+    merged['max'] = np.maximum.reduceat(rollup['max'], starts)
+    merged['first'] = rollup['first'][starts]
+    merged['last'] = rollup['last'][stops - 1]
+    return merged
+
+
+def select_rollup(rollup, start_limit=None, stop_limit=None):
+    """Returns the rows of a rollup whose interval starts within
+    [start_limit, stop_limit)"""
+    start_index, stop_index = 0, len(rollup)
+    if start_limit:
+        start_index = np.searchsorted(rollup['time'], to_epoch(start_limit))
+    if stop_limit:
+        stop_index = np.searchsorted(rollup['time'], to_epoch(stop_limit))
+    return rollup[start_index : stop_index]
+
+
+def is_aligned(limit, interval):
+    """Checks whether a limit falls on an interval boundary, so that
+    a rollup of `interval' seconds covers exactly the records within
+    the limit"""
+    return limit is None or to_epoch(limit) % interval == 0
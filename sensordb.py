@@ -35,11 +35,23 @@ import time
 import re
 import datetime
 import collections
-from common import DataRecord, DataCollection, Name
+import fnmatch
+import multiprocessing
+import multiprocessing.pool
+from common import DataCollection, Name, \
+    to_epoch, from_epoch, utc_to_local, local_to_utc, get_trace_date, get_next_month, \
+    parse_downsample, parse_numbers, count_fields
 import httplib
+import socket
+import json
 import logging
 import logging.handlers
 import numpy as np
+from cache import TraceCache, TSDBCache, DATA_CACHE
+from catalog import Catalog
+from tsdb import get_pool, parse_ascii
+from rollup import INTERVALS, build_rollup, build_rollups, merge_rollups, select_rollup, \
+    is_aligned
 
 # Log verbosely
 root_logger = logging.getLogger('')
@@ -86,27 +98,247 @@ class TSDBException(SCADAException):
     pass
 
 
+def tsdb_request(location, request_string, reader=None):
+    """Send a request to the OpenTSDB server at `location' through its
+    shared ConnectionPool. Returns the status, reason and body of the
+    response, the body as read by `reader' if given (see
+    ConnectionPool.request)"""
+    try:
+        return get_pool(location).request(request_string, reader)
+    except (httplib.HTTPException, socket.error) as e:
+        raise TSDBException("Could not reach " + location + "\nError: " + str(e))
+    except ValueError as e:
+        raise TSDBException("Could not parse the response of " + location + "\nError: " + str(e))
+
+
+# Columns of the trace files generated from the SCADA archives
+DATE_FIELD = 1
+TIME_FIELD = 2
+VALUE_FIELD = 4
+
+# Layout of the 22 byte records in the raw Broadwin .DAT archives
+DAT_RECORD = np.dtype([('timestamp', '<u4'),
+                       ('flag', '<u2'),
+                       ('values', '<f4', (4,))])
+
+
+def parse_trace_text(text):
+    """Parse the contents of a trace file in a single pass.
+
+    Returns an int64 array of timestamps (seconds since epoch) and a
+    float64 array of values. The date and time columns are converted
+    by NumPy, which avoids calling strptime for every line."""
+    text = text.replace('\r', '').replace(':', '').strip()
+    if not text:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+    counts = count_fields(text, ',')
+    columns = counts[0]
+    if columns <= VALUE_FIELD or (counts != columns).any():
+        # Lines have differing number of columns. Select the fields
+        # line by line instead.
+        rows = [line.split(',') for line in text.split('\n') \
+                    if line.count(',') >= VALUE_FIELD]
+        dates = [row[DATE_FIELD] for row in rows]
+        clock = [row[TIME_FIELD] for row in rows]
+        values = [row[VALUE_FIELD] for row in rows]
+    else:
+        fields = text.replace('\n', ',').split(',')
+        dates = fields[DATE_FIELD :: columns]
+        clock = fields[TIME_FIELD :: columns]
+        values = fields[VALUE_FIELD :: columns]
+
+    days = np.array(dates).astype('M8[D]').view(np.int64)
+    clock = parse_numbers(clock, np.int64)             # HHMMSS
+    timestamps = days * 86400 + (clock // 10000) * 3600 + \
+        (clock // 100 % 100) * 60 + clock % 100
+    return timestamps, parse_numbers(values, np.float64)
+
+
 class TraceFile(object):
-    def __init__(self, location):
+    # An unterminated last line is taken to be complete once the file
+    # was not modified for this many seconds. Until then it may still
+    # be being written and is left for read_new.
+    SETTLE_TIME = 60
+
+    def __init__(self, location, cache=None, date=None):
+        """`cache' is an optional TraceCache that keeps the parsed
+        trace file on disk. `date' is the month of the trace file, if
+        it is already known"""
         self.loc = location
+        self.cache = cache
+        self.date = date
         self.initialize()
         
     def initialize(self):
-        file_name = os.path.basename(self.loc)
-        date_str = file_name[file_name.rfind('$') + 1 : file_name.rfind('H')]
-        self.date = datetime.datetime(int(date_str[:4]), int(date_str[-2:]), 1)
+        if not self.date:
+            self.date = get_trace_date(os.path.basename(self.loc))
         self.data_cache = None
+        # Bytes of the file parsed so far, the size and modification
+        # time of the file when it was read. The offset is short of
+        # the size by a last line that is still being written. None
+        # until the file is read.
+        self.offset = None
+        self.size = None
+        self.mtime = None
         
     def get_date(self):
         return self.date
 
-    def get_data(self):
+    def get_stop_date(self):
+        """Returns the start of the month following the trace file"""
+        return get_next_month(self.date)
+
+    def overlaps(self, start_limit=None, stop_limit=None):
+        """Checks whether the month of the trace file overlaps with
+        [start_limit, stop_limit)"""
+        if start_limit and self.get_stop_date() <= start_limit:
+            return False
+        if stop_limit and self.get_date() >= stop_limit:
+            return False
+        return True
+
+    def get_data(self, start_limit=None, stop_limit=None):
+        """Read the trace file. Records outside of start_limit and
+        stop_limit are dropped"""
+        return self.make_collection(self.get_arrays(), start_limit, stop_limit)
+
+    @staticmethod
+    def make_collection(arrays, start_limit=None, stop_limit=None):
+        """Build a DataCollection from the timestamps and values in
+        `arrays', dropping records outside of start_limit and
+        stop_limit"""
+        timestamps, values = arrays
+        if start_limit or stop_limit:
+            selected = np.ones(len(timestamps), dtype=bool)
+            if start_limit:
+                selected &= timestamps >= to_epoch(start_limit)
+            if stop_limit:
+                selected &= timestamps < to_epoch(stop_limit)
+            timestamps, values = timestamps[selected], values[selected]
         data = DataCollection()
-        for line in open(self.loc, 'r'):
-            parts = line.split(',')
-            data.append(DataRecord(parts[4], parts[1], parts[2]))
+        data.append_arrays(timestamps, values)
         return data
 
+    def needs_parsing(self):
+        """Checks whether reading the trace file involves parsing it,
+        as opposed to memory mapping a cached copy"""
+        return not (self.cache and self.cache.get_header(self.loc))
+
+    def get_info(self):
+        """Describes the trace file for the Catalog. The record count
+        and time bounds are only known if the trace file is cached"""
+        header = self.cache.get_header(self.loc) if self.cache else None
+        info = {'file': os.path.basename(self.loc),
+                'date': [self.date.year, self.date.month],
+                'count': None,
+                'min_time': None,
+                'max_time': None}
+        if header:
+            for key in ('count', 'min_time', 'max_time'):
+                info[key] = header[key]
+        return info
+
+    def get_arrays(self):
+        """Returns the timestamps and values of the trace file, from
+        the cache if possible"""
+        if self.cache:
+            header = self.cache.get_header(self.loc)
+            if header:
+                self.offset = self.size = header['size']
+                self.mtime = header['mtime']
+                return self.cache.load(self.loc, header)
+        arrays = self.parse()
+        # A file is only cached when all of it was parsed
+        if self.cache and self.offset == self.size:
+            self.cache.put(self.loc, arrays[0], arrays[1], self.offset, self.mtime)
+            self.cache.put_rollups(self.loc, build_rollups(*arrays), self.offset, self.mtime)
+        return arrays
+
+    def get_rollup(self, name):
+        """Returns the rollup `name' (see rollup.INTERVALS) of the
+        trace file, from the cache if possible"""
+        if self.cache:
+            rollup = self.cache.get_rollup(self.loc, name)
+            if rollup is not None:
+                return rollup
+        rollups = build_rollups(*self.get_arrays())
+        if self.cache and self.offset == self.size:
+            self.cache.put_rollups(self.loc, rollups, self.offset, self.mtime)
+        return rollups[name]
+
+    def parse(self):
+        """Parse the complete lines of the trace file (see
+        SETTLE_TIME)"""
+        self.mtime = os.stat(self.loc).st_mtime
+        text = open(self.loc, 'r').read()
+        self.size = len(text)
+        text = self.__get_complete_lines(text)
+        self.offset = len(text)
+        return parse_trace_text(text)
+
+    def is_settled(self):
+        """Checks whether the file was last modified more than
+        SETTLE_TIME ago"""
+        return time.time() - self.mtime > self.SETTLE_TIME
+
+    def __get_complete_lines(self, text):
+        if text.endswith('\n') or self.is_settled():
+            return text
+        return text[:text.rfind('\n') + 1]
+
+    def get_read_size(self, stat):
+        """Returns the number of bytes of the file described by `stat'
+        that can be read"""
+        return stat.st_size
+
+    def has_changed(self):
+        """Checks whether the trace file was modified since it was
+        last read. Files that were never read are not considered"""
+        if self.offset is None:
+            return False
+        stat = os.stat(self.loc)
+        if self.get_read_size(stat) != self.size or stat.st_mtime != self.mtime:
+            return True
+        # A last line that was held back is read once it settles
+        return self.offset < self.size and self.is_settled()
+
+    def is_rewritten(self):
+        """Checks whether the trace file was rewritten since it was
+        last read, rather than appended to: it shrunk, or it was
+        modified without growing"""
+        if self.offset is None:
+            return False
+        stat = os.stat(self.loc)
+        size = self.get_read_size(stat)
+        return size < self.size or (size == self.size and stat.st_mtime != self.mtime)
+
+    def read_new(self):
+        """Returns the timestamps and values of the records appended
+        to the trace file since it was last read, parsing only the
+        appended lines. A line that is still being written is left for
+        a later call, so that no line is parsed twice. If the file was
+        rewritten, all of it is returned"""
+        if self.offset is None or self.is_rewritten():
+            return self.get_arrays()
+        self.mtime = os.stat(self.loc).st_mtime
+        f = open(self.loc, 'r')
+        try:
+            f.seek(self.offset)
+            text = f.read()
+        finally:
+            f.close()
+        self.size = self.offset + len(text)
+        text = self.__get_complete_lines(text)
+        offset = self.offset
+        self.offset += len(text)
+        timestamps, values = parse_trace_text(text)
+        if self.cache and self.offset == self.size:
+            self.cache.append(self.loc, timestamps, values, offset, self.offset, self.mtime)
+            self.cache.append_rollups(self.loc, build_rollups(timestamps, values),
+                                      offset, self.offset, self.mtime)
+        return timestamps, values
+
     def __repr__(self):
         return 'Trace type: ' + os.path.dirname(self.loc) + \
             '\tTrace Date: ' + str(self.date)
@@ -115,22 +347,153 @@ class TraceFile(object):
         return repr(self)    
 
 
+class DatTraceFile(TraceFile):
+    """Trace file backed by a raw Broadwin .DAT archive. The archive is
+    memory mapped directly, which avoids the conversion to CSV done by
+    parse_scada and parsing the text back. Only the rollups of the
+    archive are cached"""
+    
+    def get_records(self, start_limit=None, stop_limit=None):
+        """Return the records between start_limit and stop_limit as a
+        view on the memory mapped archive"""
+        stat = os.stat(self.loc)
+        count = stat.st_size // DAT_RECORD.itemsize
+        self.offset = self.size = count * DAT_RECORD.itemsize
+        self.mtime = stat.st_mtime
+        if not count:
+            return np.empty(0, dtype=DAT_RECORD)
+        records = np.memmap(self.loc, dtype=DAT_RECORD, mode='r', shape=(count,))
+        timestamps = records['timestamp']
+        start_index = 0
+        stop_index = count
+        if start_limit:
+            start_index = np.searchsorted(timestamps, local_to_utc(start_limit))
+        if stop_limit:
+            stop_index = np.searchsorted(timestamps, local_to_utc(stop_limit))
+        return records[start_index : stop_index]
+
+    def get_data(self, start_limit=None, stop_limit=None):
+        """Read the archive. Records outside of start_limit and
+        stop_limit are not touched"""
+        data = DataCollection()
+        data.append_arrays(*self.__convert(self.get_records(start_limit, stop_limit)))
+        return data
+
+    def get_arrays(self):
+        return self.parse()
+
+    def parse(self):
+        return self.__convert(self.get_records())
+
+    def needs_parsing(self):
+        return False
+
+    def get_read_size(self, stat):
+        # A record that is still being written is not counted
+        return stat.st_size // DAT_RECORD.itemsize * DAT_RECORD.itemsize
+
+    def read_new(self):
+        offset = self.offset
+        rewritten = self.is_rewritten()
+        records = self.get_records()
+        if offset is None or rewritten:
+            return self.__convert(records)
+        timestamps, values = self.__convert(records[offset // DAT_RECORD.itemsize:])
+        if self.cache:
+            self.cache.append_rollups(self.loc, build_rollups(timestamps, values),
+                                      offset, self.offset, self.mtime)
+        return timestamps, values
+
+    def get_info(self):
+        info = super(DatTraceFile, self).get_info()
+        records = self.get_records()
+        info['count'] = len(records)
+        if len(records):
+            bounds = utc_to_local(records['timestamp'][[0, -1]])
+            info['min_time'], info['max_time'] = int(bounds[0]), int(bounds[1])
+        return info
+
+    def __convert(self, records):
+        # Only the first of the four values is of use
+        return utc_to_local(records['timestamp']), \
+            records['values'][:, 0].astype(np.float64)
+
+
+def _parse_trace_file(trace_file):
+    """Parse a trace file within a worker process. If the trace file
+    is cached, the records are written to the cache instead of being
+    sent back to the parent process. The offset, size and mtime of
+    the trace file are returned along with the records"""
+    arrays = trace_file.parse()
+    if trace_file.cache and trace_file.offset == trace_file.size:
+        trace_file.cache.put(trace_file.loc, arrays[0], arrays[1],
+                             trace_file.offset, trace_file.mtime)
+        trace_file.cache.put_rollups(trace_file.loc, build_rollups(*arrays),
+                                     trace_file.offset, trace_file.mtime)
+        if trace_file.cache.get_header(trace_file.loc):
+            arrays = None
+    return arrays, trace_file.offset, trace_file.size, trace_file.mtime
+
+
+def load_trace_files(jobs, workers=1):
+    """Read trace files and return their DataCollections in order.
+    `jobs' is a list of (trace file, start_limit, stop_limit) tuples.
+
+    With more than one worker, files that have to be parsed are parsed
+    by a pool of processes and files that are memory mapped (raw
+    archives and cached months) are read by a pool of threads."""
+    if workers <= 1 or len(jobs) <= 1:
+        return [trace_file.get_data(start_limit, stop_limit) \
+                    for trace_file, start_limit, stop_limit in jobs]
+
+    results = [None] * len(jobs)
+    to_parse = [index for index, job in enumerate(jobs) if job[0].needs_parsing()]
+    if to_parse:
+        pool = multiprocessing.Pool(min(workers, len(to_parse)))
+        try:
+            parsed = pool.map(_parse_trace_file, [jobs[index][0] for index in to_parse])
+        finally:
+            pool.close()
+            pool.join()
+        for index, (arrays, offset, size, mtime) in zip(to_parse, parsed):
+            trace_file, start_limit, stop_limit = jobs[index]
+            trace_file.offset, trace_file.size, trace_file.mtime = offset, size, mtime
+            if arrays is not None:
+                results[index] = trace_file.make_collection(arrays, start_limit, stop_limit)
+
+    to_map = [index for index in range(len(jobs)) if results[index] is None]
+    if to_map:
+        pool = multiprocessing.pool.ThreadPool(min(workers, len(to_map)))
+        try:
+            mapped = pool.map(lambda index: jobs[index][0].get_data(*jobs[index][1:]),
+                              to_map)
+        finally:
+            pool.close()
+            pool.join()
+        for index, data in zip(to_map, mapped):
+            results[index] = data
+    return results
+
+
 class SensorTrace(object):
     def __init__(self, sensor_name, start_limit=None, stop_limit=None):
         self.name = sensor_name
         self.trace_data = DataCollection(start_limit, stop_limit)
         self.start_limit = start_limit
         self.stop_limit = stop_limit
+        self.parsed_name = None
         self.initialize()
 
     def initialize(self):
         pass
 
     def __repr__(self):
-        return repr(Name(self.name))
+        return repr(self.get_name())
 
     def get_name(self):
-        return Name(self.name)
+        if not self.parsed_name:
+            self.parsed_name = Name(self.name)
+        return self.parsed_name
 
     def get_type(self):
         return self.get_name().type
@@ -142,24 +505,96 @@ class SensorTrace(object):
         """Returns the length of the trace as a timedelta object"""
         return self.trace_data.get_length()
 
-    def get_data_tuples(self, start_limit=None, stop_limit=None):
+    def get_data_tuples(self, start_limit=None, stop_limit=None, downsample=None):
         """Retrieve data and timestamps from the data collection.
 
         start_limit and stop_limit are optional arguments that
         describe the subsection of the trace to operate on. If these
         options are not provided, then any arguments provided on
-        object intialization will be used."""
+        object intialization will be used. `downsample' is an optional
+        downsample spec such as 1h-avg or 15m-max (see load_data)."""
         start_limit, stop_limit = self.get_limits(start_limit, stop_limit)
-        data = self.load_data(start_limit, stop_limit)
         self.trace_data = DataCollection(start_limit, stop_limit)
-        self.trace_data.append(data)
+        self.trace_data.append_arrays(*self.get_cached_data(start_limit, stop_limit, downsample) \
+                                          .get_epoch_tuples(start_limit, stop_limit))
         return self.trace_data.get_data_tuples(start_limit, stop_limit)
 
+    def get_cached_data(self, start_limit, stop_limit, downsample=None):
+        """Returns a DataCollection that covers [start_limit,
+        stop_limit), from DATA_CACHE if possible"""
+        key = self.get_cache_key()
+        if key and downsample:
+            key += (downsample,)
+        if key and not stop_limit:
+            # An open ended range is cached up to where the data of the
+            # trace ends now, so that later data is loaded once it exists
+            stop_limit = self.get_stop_time()
+        data = DATA_CACHE.get(key, start_limit, stop_limit) if key else None
+        if data is None:
+            data = DataCollection()
+            data.append(self.load_data(start_limit, stop_limit, downsample=downsample))
+            if key:
+                DATA_CACHE.put(key, start_limit, stop_limit, data)
+        return data
+
+    def get_cache_key(self):
+        """Identifies the sensor within DATA_CACHE. Traces that return
+        None are not cached"""
+        return None
+
+    def get_rollup(self, name, start_limit=None, stop_limit=None):
+        """Returns the rollup `name' (see rollup.INTERVALS) of the
+        records in [start_limit, stop_limit)"""
+        start_limit, stop_limit = self.get_limits(start_limit, stop_limit)
+        return build_rollup(*self.get_cached_data(start_limit, stop_limit) \
+                                .get_epoch_tuples(start_limit, stop_limit),
+                            interval=INTERVALS[name])
+
+    def iter_chunks(self, start_limit=None, stop_limit=None, chunk=None):
+        """Generate the data of the trace as time ordered blocks of
+        (timestamps, values) arrays, the timestamps being datetime64
+        values. Only one block is held in memory at a time.
+
+        `chunk' is the time span of a block as a timedelta. By default
+        every block holds a calendar month. Blocks without records are
+        skipped."""
+        start_limit, stop_limit = self.get_limits(start_limit, stop_limit)
+        if not stop_limit:
+            stop_limit = self.get_stop_time()
+        while start_limit and stop_limit and start_limit < stop_limit:
+            if chunk:
+                chunk_stop = start_limit + chunk
+            else:
+                chunk_stop = get_next_month(start_limit)
+            chunk_stop = min(chunk_stop, stop_limit)
+            timestamps, values = self.load_chunk(start_limit, chunk_stop)
+            if len(timestamps):
+                yield timestamps.view('M8[s]'), values
+            start_limit = chunk_stop
+
+    def load_chunk(self, start_limit, stop_limit):
+        """Returns the timestamps and values in [start_limit,
+        stop_limit), from DATA_CACHE if possible. Nothing is added to
+        DATA_CACHE"""
+        key = self.get_cache_key()
+        data = DATA_CACHE.get(key, start_limit, stop_limit) if key else None
+        if data is None:
+            data = DataCollection()
+            data.append(self.load_data(start_limit, stop_limit))
+        return data.get_epoch_tuples(start_limit, stop_limit)
+
+    def get_stop_time(self):
+        """Returns the time the data of the trace ends at, if known"""
+        return datetime.datetime.now()
+
     def get_data_collection(self):
         self.get_data_tuples()
         return self.trace_data
 
-    def load_data(self, start_limit=None, stop_limit=None):
+    def load_data(self, start_limit=None, stop_limit=None, downsample=None):
+        """Load the records of the trace. With a `downsample' spec such
+        as 1h-avg, the records are aggregated into intervals (see
+        common.downsample)"""
         log.warn('Empty load data is called. This should typically not happen')
         pass
 
@@ -189,6 +624,15 @@ class SensorTrace(object):
 
 class TSDBTrace(SensorTrace):
     TIME_FORMAT = '%Y/%m/%d-%H:%M:%S'
+    # Directory of the TSDBCaches of query results, None disables them
+    cache_directory = TSDBCache.DEFAULT_DIRECTORY
+    # Data younger than this may still change and is not cached
+    SETTLE_TIME = datetime.timedelta(hours=1)
+    # Long requests are split into windows of this length (a
+    # timedelta), calendar months by default
+    FETCH_WINDOW = None
+    # Number of windows of a request fetched in parallel
+    FETCH_WORKERS = 4
     
     def __init__(self, loc, sensor_name, start_limit=None, stop_limit=None, prefix='SCADA.SODA'):
         self.prefix = prefix
@@ -197,91 +641,427 @@ class TSDBTrace(SensorTrace):
                                         start_limit,
                                         stop_limit)
         
+    def get_cache_key(self):
+        return ('tsdb', self.loc, self.prefix, self.name)
+
     @staticmethod
     def get_tsdb_metrics(location, prefix):
         request_string = '/suggest?type=metrics&q=' + prefix
-        conn = httplib.HTTPConnection(location)
-        conn.request("GET", request_string)
-        response = conn.getresponse()
-        if response.status != 200:
-            raise TSDBException("Could not load Sensor Names.\nError: " + response.reason)
-        data = response.read()
-        return [sensor[sensor.rfind('.') + 1 : ] for sensor in eval(data)]
+        status, reason, data = tsdb_request(location, request_string)
+        if status != 200:
+            raise TSDBException("Could not load Sensor Names.\nError: " + reason)
+        try:
+            metrics = json.loads(data)
+        except ValueError:
+            raise TSDBException("Could not parse Sensor Names: " + data[:100])
+        return [str(sensor[sensor.rfind('.') + 1 : ]) for sensor in metrics]
     
-    def load_data(self, start_limit=None, stop_limit=None):
-        start_limit, stop_limit = self.get_limits(start_limit, stop_limit)
+    def get_metric(self):
+        return self.prefix + '.' + self.name
+
+    def load_data(self, start_limit=None, stop_limit=None, downsample=None):
+        return self.load_batch([self], start_limit, stop_limit, downsample)[0]
+
+    def get_tsdb_cache_key(self, downsample=None):
+        """Identifies the results of the trace within its TSDBCache"""
+        if downsample:
+            return (self.prefix, self.name, 'avg:' + downsample)
+        return (self.prefix, self.name, 'avg')
+
+    @classmethod
+    def get_tsdb_cache(cls, location):
+        """Returns the TSDBCache of `location' or None if caching is
+        disabled"""
+        if not cls.cache_directory:
+            return None
+        return TSDBCache(os.path.join(cls.cache_directory,
+                                      TSDBCache.UNSAFE_CHARS.sub('_', location)))
+
+    @classmethod
+    def load_batch(cls, traces, start_limit=None, stop_limit=None, downsample=None):
+        """Load the data of several traces of the same TSDB location.
+        The limits of the first trace apply to all of them. A
+        `downsample' spec is passed on to the server.
+
+        Data older than SETTLE_TIME is read through the TSDBCache of
+        the location, so only the intervals that are not cached yet
+        are requested. Every request covers all traces that miss the
+        same interval. Returns a DataCollection for every trace, in
+        the order of `traces'"""
+        start_limit, stop_limit = traces[0].get_limits(start_limit, stop_limit)
         if not start_limit:
             raise TSDBException("Starting time should be given")        
-        
-        request_string = '/q?start=' + start_limit.strftime(self.TIME_FORMAT)
         if not stop_limit:
             stop_limit = datetime.datetime.now()
+        if downsample:
+            parse_downsample(downsample)
+
+        cache = cls.get_tsdb_cache(traces[0].loc)
+        if not cache:
+            arrays = cls.__fetch(traces, start_limit, stop_limit, downsample)
+            return [cls.__make_collection(arrays.get(trace.get_metric()), start_limit, stop_limit) \
+                        for trace in traces]
+
+        settled = max(start_limit, min(stop_limit, datetime.datetime.now() - cls.SETTLE_TIME))
+        if downsample:
+            settled = max(start_limit, cls.align_limit(settled, downsample))
+        gaps = {}
+        missing = collections.defaultdict(list)
+        for trace in traces:
+            gaps[trace] = cache.get_gaps(trace.get_tsdb_cache_key(downsample), start_limit, settled)
+            if downsample:
+                gaps[trace] = cls.align_gaps(gaps[trace], downsample)
+            missing[tuple(gaps[trace])].append(trace)
+        # The fetched records are used as they are, rather than read
+        # back from the cache, which may have failed to store them
+        fetched = collections.defaultdict(list)
+        for trace_gaps, gap_traces in missing.items():
+            for gap_start, gap_stop in trace_gaps:
+                gap_start, gap_stop = from_epoch(gap_start), from_epoch(gap_stop)
+                log.info("Fetching " + str(gap_start) + " - " + str(gap_stop) + " of " + \
+                             ', '.join([trace.name for trace in gap_traces]))
+                arrays = cls.__fetch(gap_traces, gap_start, gap_stop, downsample, cache)
+                for trace in gap_traces:
+                    fetched[trace].append(cls.__make_collection(arrays.get(trace.get_metric()),
+                                                                max(gap_start, start_limit),
+                                                                gap_stop))
+
+        recent = {}
+        if settled < stop_limit:
+            recent = cls.__query(traces, settled, stop_limit, downsample)
+        results = []
+        for trace in traces:
+            data = cls.__make_collection(recent.get(trace.get_metric()), settled, stop_limit)
+            timestamps, values = cache.load(trace.get_tsdb_cache_key(downsample),
+                                            start_limit, settled)
+            cached = np.ones(len(timestamps), dtype=bool)
+            for gap_start, gap_stop in gaps[trace]:
+                cached &= (timestamps < gap_start) | (timestamps >= gap_stop)
+            data.append_arrays(timestamps[cached], values[cached])
+            for part in fetched[trace]:
+                data.append(part)
+            results.append(data)
+        return results
 
-        # FIXME: Adding constant 7 hours to overcome time zone delta
-        delta = datetime.datetime(2010, 1, 1, 8) - datetime.datetime(2010, 1, 1, 1)
-        start_limit += delta
-        stop_limit += delta
-        
-        request_string += '&end=' + stop_limit.strftime(self.TIME_FORMAT)
-        request_string += '&m=avg:' + self.prefix + '.' + self.name
+    @staticmethod
+    def align_limit(limit, downsample, up=False):
+        """Round the local time `limit' down (or with `up' set, up) to
+        the start of an interval of the `downsample' spec. The server
+        aligns the intervals to UNIX time, not to local time"""
+        seconds = parse_downsample(downsample)[0]
+        timestamp = local_to_utc(limit)
+        aligned = timestamp - timestamp % seconds
+        if up and aligned < timestamp:
+            aligned += seconds
+        return from_epoch(utc_to_local([aligned])[0])
+
+    @classmethod
+    def align_gaps(cls, gaps, downsample):
+        """Widen the (start, stop) gaps of a TSDBCache (in seconds since
+        epoch) to whole intervals of the `downsample' spec, so that no
+        interval is aggregated from part of its records. Gaps that
+        come to overlap are merged"""
+        aligned = []
+        for start, stop in gaps:
+            start = to_epoch(cls.align_limit(start, downsample))
+            stop = to_epoch(cls.align_limit(stop, downsample, up=True))
+            if aligned and start <= aligned[-1][1]:
+                aligned[-1] = (aligned[-1][0], max(aligned[-1][1], stop))
+            else:
+                aligned.append((start, stop))
+        return aligned
+
+    @classmethod
+    def get_windows(cls, start_limit, stop_limit, downsample=None):
+        """Split [start_limit, stop_limit) into the windows that are
+        requested separately (see FETCH_WINDOW). With a `downsample'
+        spec, windows are split at the start of an interval of the
+        spec only"""
+        windows = []
+        while start_limit < stop_limit:
+            if cls.FETCH_WINDOW:
+                window_stop = start_limit + cls.FETCH_WINDOW
+            else:
+                window_stop = get_next_month(start_limit)
+            if downsample:
+                aligned = cls.align_limit(window_stop, downsample)
+                if aligned > start_limit:
+                    window_stop = aligned
+                else:
+                    window_stop = cls.align_limit(window_stop, downsample, up=True)
+            window_stop = min(window_stop, stop_limit)
+            windows.append((start_limit, window_stop))
+            start_limit = window_stop
+        return windows
+
+    @classmethod
+    def __fetch(cls, traces, start_limit, stop_limit, downsample=None, cache=None):
+        """Request the data of `traces' one window at a time (see
+        get_windows), fetching FETCH_WORKERS windows in parallel. With
+        a TSDBCache, every window is added to the cache as it arrives.
+        The windows are stitched together in order and returned as by
+        __query"""
+        windows = cls.get_windows(start_limit, stop_limit, downsample)
+        def fetch(index):
+            window_start, window_stop = windows[index]
+            arrays = cls.__query(traces, window_start, window_stop, downsample)
+            if cache:
+                for trace in traces:
+                    timestamps, values = arrays.get(trace.get_metric(), ([], []))
+                    cache.add(trace.get_tsdb_cache_key(downsample), window_start, window_stop,
+                              timestamps, values)
+            # Records on the boundary of two windows are returned for both
+            for metric, (timestamps, values) in arrays.items():
+                selected = np.ones(len(timestamps), dtype=bool)
+                if index > 0:
+                    selected &= timestamps >= to_epoch(window_start)
+                if index < len(windows) - 1:
+                    selected &= timestamps < to_epoch(window_stop)
+                arrays[metric] = (timestamps[selected], values[selected])
+            return arrays
+
+        if len(windows) > 1:
+            pool = multiprocessing.pool.ThreadPool(min(cls.FETCH_WORKERS, len(windows)))
+            try:
+                fetched = pool.map(fetch, range(len(windows)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            fetched = [fetch(index) for index in range(len(windows))]
+
+        arrays = {}
+        for metric in set([metric for window in fetched for metric in window]):
+            parts = [window[metric] for window in fetched if metric in window]
+            arrays[metric] = (np.concatenate([part[0] for part in parts]),
+                              np.concatenate([part[1] for part in parts]))
+        return arrays
+
+    @classmethod
+    def __query(cls, traces, start_limit, stop_limit, downsample=None):
+        """Request the data of `traces' from the TSDB server. Returns a
+        dictionary of metric to timestamps (local time) and values"""
+        # The limits are sent as UNIX timestamps, which do not depend
+        # on the time zone of the server
+        request_string = '/q?start=' + str(local_to_utc(start_limit)) + \
+            '&end=' + str(local_to_utc(stop_limit))
+        aggregation = 'avg:'
+        if downsample:
+            aggregation += downsample + ':'
+        for trace in traces:
+            request_string += '&m=' + aggregation + trace.get_metric()
         request_string += '&ascii'
 
-        conn = httplib.HTTPConnection(self.loc)
-        conn.request("GET", request_string)
-        response = conn.getresponse()
-        if response.status != 200:
-            raise TSDBException("Could not load Sensor Data: " + self.name + "\nError: " + response.reason)
-        
-        return self.__parse_data(response.read())        
+        names = ', '.join([trace.name for trace in traces])
+        # The response is parsed as it arrives
+        status, reason, arrays = tsdb_request(traces[0].loc, request_string, parse_ascii)
+        if status != 200:
+            raise TSDBException("Could not load Sensor Data: " + names + "\nError: " + reason)
+        for metric, (timestamps, values) in arrays.items():
+            arrays[metric] = (utc_to_local(timestamps), values)
+        return arrays
+
+    @staticmethod
+    def __make_collection(arrays, start_limit=None, stop_limit=None):
+        if not arrays:
+            return DataCollection()
+        return TraceFile.make_collection(arrays, start_limit, stop_limit)
 
-    def __parse_data(self, data):
-        return [DataRecord(line.split()[2], int(line.split()[1])) \
-                    for line in data.splitlines()]
 
-                                
 class FileTrace(SensorTrace):
-    def __init__(self, loc, start_limit=None, stop_limit=None):
+    def __init__(self, loc, start_limit=None, stop_limit=None, cache=True, workers=1,
+                 catalog_entry=None):
+        """If `cache' is set, parsed trace files are kept in a
+        TraceCache within the trace directory. `workers' is the
+        number of trace files that are read in parallel.
+        `catalog_entry' is an entry of a Catalog (see get_info), which
+        saves listing the trace directory"""
         self.loc = loc
         self.trace_files = []
+        self.workers = workers
+        self.catalog_entry = catalog_entry
+        self.cache = None
+        if cache:
+            self.cache = TraceCache(os.path.join(loc, TraceCache.DIR_NAME))
         super(FileTrace, self).__init__(os.path.basename(loc),
                                         start_limit,
                                         stop_limit)
         
     def initialize(self):
-        self.trace_files = [TraceFile(os.path.join(self.loc, file_name)) \
-                                for file_name in os.listdir(self.loc) \
-                                if file_name.endswith('H.DAT.csv')]
+        if self.catalog_entry:
+            self.parsed_name = Name.from_fields(self.name, self.catalog_entry['name'])
+            self.trace_files = [self.__make_trace_file(info['file'],
+                                                       datetime.datetime(info['date'][0],
+                                                                         info['date'][1], 1)) \
+                                    for info in self.catalog_entry['files']]
+            return
+
+        self.trace_files = [self.__make_trace_file(file_name) \
+                                for file_name in self.__list_files()]
+
+    def __list_files(self):
+        """Returns the names of the trace files in the trace directory"""
+        file_names = os.listdir(self.loc)
+        raw_files = set([file_name for file_name in file_names \
+                             if file_name.endswith('H.DAT')])
+        # Read the raw archives directly wherever they are available
         # Ignore the Monthly aggregates
+        return sorted(raw_files) + \
+            sorted([file_name for file_name in file_names \
+                        if file_name.endswith('H.DAT.csv') and \
+                        file_name[:-len('.csv')] not in raw_files])
+
+    def __make_trace_file(self, file_name, date=None):
+        if file_name.endswith('H.DAT'):
+            return DatTraceFile(os.path.join(self.loc, file_name), self.cache, date)
+        return TraceFile(os.path.join(self.loc, file_name), self.cache, date)
+
+    def get_cache_key(self):
+        return ('file', os.path.abspath(self.loc))
+
+    def get_info(self):
+        """Describes the trace for the Catalog"""
+        return {'name': self.get_name().get_fields(),
+                'files': [trace.get_info() for trace in self.trace_files]}
             
+    def get_stop_time(self):
+        if not self.trace_files:
+            return None
+        return max([trace.get_stop_date() for trace in self.trace_files])
+
     def get_length(self):
         """Returns the trace length in months"""
         dates = [trace.get_date() for trace in self.trace_files]
         return ((max(dates) - min(dates)) / 30).days
 
-    def load_data(self, start_limit=None, stop_limit=None):
-        return_records = DataCollection()
-        for trace in self.trace_files:
-            log.info("Loading file: " + trace.loc)
-            if start_limit and trace.get_date() < start_limit:
+    def get_cached_data(self, start_limit, stop_limit, downsample=None):
+        # Only the records themselves are cached and downsampled on
+        # request, which leaves a single cached copy to refresh
+        data = super(FileTrace, self).get_cached_data(start_limit, stop_limit)
+        if downsample:
+            data = data.get_downsampled(downsample, start_limit, stop_limit)
+        return data
+
+    def get_rollup(self, name, start_limit=None, stop_limit=None):
+        """Merges the materialized rollups of the trace files, keeping
+        the intervals that start within [start_limit, stop_limit)"""
+        start_limit, stop_limit = self.get_limits(start_limit, stop_limit)
+        return select_rollup(merge_rollups([trace.get_rollup(name) \
+                                                for trace in self.trace_files \
+                                                if trace.overlaps(start_limit, stop_limit)]),
+                             start_limit, stop_limit)
+
+    def get_summary(self):
+        """Summarizes the trace from its hourly rollup when the limits
+        fall on hours. The rollup is only used if all values are
+        positive, as the non-positive values are left out"""
+        start_limit, stop_limit = self.get_limits(None, None)
+        interval = INTERVALS['hourly']
+        if is_aligned(start_limit, interval) and is_aligned(stop_limit, interval):
+            rollup = self.get_rollup('hourly', start_limit, stop_limit)
+            if (rollup['min'] > 0).all():
+                if not len(rollup):
+                    return {'min': np.nan, 'ave': np.nan, 'max': np.nan}
+                return {'min': rollup['min'].min(),
+                        'ave': rollup['sum'].sum() / rollup['count'].sum(),
+                        'max': rollup['max'].max()}
+        return super(FileTrace, self).get_summary()
+
+    def load_data(self, start_limit=None, stop_limit=None, downsample=None, workers=None):
+        return_records = DataCollection(unique=True)
+        for data in load_trace_files(self.get_jobs(start_limit, stop_limit),
+                                     workers or self.workers):
+            return_records.append(data)
+        if downsample:
+            return return_records.get_downsampled(downsample)
+        return return_records
+
+    def refresh(self):
+        """Pick up trace files added to the trace directory and records
+        appended to the trace files read so far, parsing only the new
+        data. The new records are added to trace_data and to the data
+        of the trace in DATA_CACHE, and returned as a DataCollection.
+
+        If a trace file was rewritten rather than appended to, the
+        trace is dropped from DATA_CACHE and trace_data is reloaded
+        and returned as a whole"""
+        new_data = DataCollection(unique=True)
+        # A month is known by its raw archive or its CSV conversion
+        known = set([os.path.basename(trace.loc).replace('.csv', '') \
+                         for trace in self.trace_files])
+        for file_name in self.__list_files():
+            if file_name.replace('.csv', '') in known:
                 continue
-            if stop_limit and trace.get_date() > stop_limit:
+            trace = self.__make_trace_file(file_name)
+            log.info("New trace file: " + trace.loc)
+            new_data.append_arrays(*trace.get_arrays())
+            self.trace_files.append(trace)
+        rewritten = False
+        for trace in self.trace_files:
+            if trace.is_rewritten():
+                log.info("Trace file was rewritten: " + trace.loc)
+                trace.read_new()
+                rewritten = True
+            elif trace.has_changed():
+                log.info("Reading new records of: " + trace.loc)
+                new_data.append_arrays(*trace.read_new())
+        if rewritten:
+            DATA_CACHE.invalidate(self.get_cache_key())
+            self.get_data_tuples(self.trace_data.start_limit, self.trace_data.stop_limit)
+            return self.trace_data
+        if len(new_data):
+            self.trace_data.append(new_data)
+            DATA_CACHE.extend(self.get_cache_key(), new_data)
+        return new_data
+
+    def get_jobs(self, start_limit=None, stop_limit=None):
+        """Returns the trace files to read for the given limits, as
+        expected by load_trace_files"""
+        jobs = []
+        for trace in self.trace_files:
+            if not trace.overlaps(start_limit, stop_limit):
                 continue
-            return_records.append(trace.get_data())
-        return return_records
+            log.info("Loading file: " + trace.loc)
+            jobs.append((trace, start_limit, stop_limit))
+        return jobs
 
 
 class TSTrace(object):
     """Access TS data from various sources"""
-    def __init__(self, location='prmohan-ec2.dyndns.org:4242', start_limit=None, stop_limit=None, prefix='SCADA.SODA'):
+    # Number of TSDB metrics requested by a single query
+    BATCH_SIZE = 20
+
+    def __init__(self, location='prmohan-ec2.dyndns.org:4242', start_limit=None, stop_limit=None, prefix='SCADA.SODA',
+                 batch_size=BATCH_SIZE):
         self.traces = []
+        self.location = location
         self.start_limit = start_limit
         self.stop_limit = stop_limit
         self.prefix = prefix
+        self.batch_size = batch_size
+        self.load_report = []
+        self.load_errors = {}
 
         if location.find('4242') != -1:
             self.__tsdb_trace_initialize(location)
         else:
             self.__file_trace_initialize(location)        
+        self.reindex()
+
+    def reindex(self):
+        """Build the indexes of the traces by name, type, room and
+        floor. This has to be called whenever `traces' is changed"""
+        self.name_index = {}
+        self.type_index = collections.defaultdict(list)
+        self.room_index = collections.defaultdict(list)
+        self.floor_index = collections.defaultdict(list)
+        for trace in self.traces:
+            name = trace.get_name()
+            self.name_index[name.name] = trace
+            self.type_index[name.type].append(trace)
+            if name.is_room():
+                self.room_index[name.room_no].append(trace)
+                self.floor_index[name.floor].append(trace)
 
     def __tsdb_trace_initialize(self, location):
         self.traces = [TSDBTrace(location, sensor_name, self.start_limit, \
@@ -289,26 +1069,222 @@ class TSTrace(object):
                        for sensor_name in TSDBTrace.get_tsdb_metrics(location, self.prefix)]
         
     def __file_trace_initialize(self, directory):
-        self.traces = [FileTrace(os.path.join(directory, sensor_name),
-                                   self.start_limit, self.stop_limit) \
-                           for sensor_name in os.listdir(directory)]
+        self.traces = []
+        self.__add_file_traces(directory)
+
+    def __add_file_traces(self, directory):
+        """Add a FileTrace for every sensor directory that is not yet
+        part of the trace"""
+        # The catalog saves listing every sensor directory
+        catalog = Catalog(directory)
+        known = set([trace.name for trace in self.traces])
+        for sensor_name in catalog.get_sensor_names():
+            if sensor_name in known:
+                continue
+            entry = catalog.get_entry(sensor_name)
+            trace = FileTrace(os.path.join(directory, sensor_name),
+                              self.start_limit, self.stop_limit,
+                              catalog_entry=entry)
+            if not entry:
+                catalog.put_entry(sensor_name, trace.get_info())
+            self.traces.append(trace)
+        catalog.save()
+
+    def refresh(self):
+        """Bring a file based trace up to date with its directory: new
+        records and trace files of the known sensors are read (see
+        FileTrace.refresh) and new sensor directories are added.
+
+        Returns a dictionary of sensor name to the DataCollection of
+        new records, for the sensors that have any"""
+        new_data = {}
+        for trace in self.traces:
+            if isinstance(trace, FileTrace):
+                data = trace.refresh()
+                if len(data):
+                    new_data[trace.name] = data
+        if self.location.find('4242') == -1:
+            count = len(self.traces)
+            self.__add_file_traces(self.location)
+            if len(self.traces) != count:
+                self.reindex()
+        return new_data
+
+    def load_all(self, start_limit=None, stop_limit=None, workers=1, downsample=None):
+        """Load the data of all sensors in the trace. The trace files
+        of all FileTraces are read by `workers' processes and threads
+        (see load_trace_files), other traces are loaded by `workers'
+        threads. TSDBTraces are requested batch_size metrics at a time
+        (see TSDBTrace.load_batch), with up to `workers' requests in
+        flight.
+
+        Every request is timed and listed in load_report. Sensors that
+        fail to load are left out of the result and their errors are
+        kept in load_errors, so one failing sensor does not abort the
+        whole load.
+
+        With a `downsample' spec such as 1h-avg, TSDBTraces are
+        downsampled by the server and other traces after loading.
+
+        Returns a dictionary of sensor name to DataCollection. The
+        collections are also kept as trace_data of every trace and in
+        DATA_CACHE."""
+        if not start_limit:
+            start_limit = self.start_limit
+        if not stop_limit:
+            stop_limit = self.stop_limit
+
+        results = {}
+        self.load_report = []
+        self.load_errors = {}
+        file_traces = [trace for trace in self.traces if isinstance(trace, FileTrace)]
+        other_traces = [trace for trace in self.traces if not isinstance(trace, FileTrace)]
+
+        # Where the data of every trace ends before loading, which is
+        # the end of the cached range of open ended loads (see
+        # SensorTrace.get_cached_data)
+        stop_times = dict([(trace, trace.get_limits(start_limit, stop_limit)[1] or \
+                                trace.get_stop_time()) for trace in self.traces])
+
+        jobs = []
+        owners = []
+        for trace in file_traces:
+            results[trace] = DataCollection(unique=True)
+            trace_jobs = trace.get_jobs(*trace.get_limits(start_limit, stop_limit))
+            jobs.extend(trace_jobs)
+            owners.extend([trace] * len(trace_jobs))
+        for trace, data in zip(owners, load_trace_files(jobs, workers)):
+            results[trace].append(data)
+
+        if other_traces:
+            batches = self.get_batches(other_traces, start_limit, stop_limit)
+            # Let every worker hold a connection of its own
+            for location in set([batch[0].loc for batch in batches \
+                                     if isinstance(batch[0], TSDBTrace)]):
+                if get_pool(location).size < workers:
+                    get_pool(location).set_size(workers)
+            pool = multiprocessing.pool.ThreadPool(max(1, min(workers, len(batches))))
+            try:
+                loaded = pool.map(lambda batch: self.__load_batch(batch, start_limit,
+                                                                  stop_limit, downsample),
+                                  batches)
+            finally:
+                pool.close()
+                pool.join()
+            for batch, batch_data in zip(batches, loaded):
+                for trace, data in zip(batch, batch_data):
+                    if data is None:
+                        continue
+                    results[trace] = DataCollection()
+                    results[trace].append(data)
+            self.log_load_report()
+
+        sensor_data = {}
+        for trace, data in results.items():
+            trace_start, trace_stop = trace.get_limits(start_limit, stop_limit)
+            key = trace.get_cache_key()
+            if key and downsample and isinstance(trace, TSDBTrace):
+                key += (downsample,)
+            if key:
+                DATA_CACHE.put(key, trace_start, stop_times[trace], data)
+            if downsample and not isinstance(trace, TSDBTrace):
+                data = data.get_downsampled(downsample)
+            trace.trace_data = DataCollection(trace_start, trace_stop)
+            trace.trace_data.append(data)
+            sensor_data[trace.name] = trace.trace_data
+        return sensor_data
+
+    def __load_batch(self, batch, start_limit, stop_limit, downsample=None):
+        """Load a batch of traces (see get_batches). A batch that fails
+        is loaded again trace by trace to find the failing sensors.
+        Returns the data of every trace of the batch, None for the
+        traces that failed"""
+        limits = batch[0].get_limits(start_limit, stop_limit)
+        started = time.time()
+        try:
+            if isinstance(batch[0], TSDBTrace):
+                loaded = TSDBTrace.load_batch(batch, limits[0], limits[1], downsample)
+            else:
+                loaded = [batch[0].load_data(*limits)]
+            error = None
+        except Exception as e:
+            loaded = None
+            error = str(e)
+        self.load_report.append({'sensors': [trace.name for trace in batch],
+                                 'latency': time.time() - started,
+                                 'records': sum([len(data) for data in loaded or []]),
+                                 'error': error})
+        if not error:
+            return loaded
+        if len(batch) > 1:
+            return [self.__load_batch([trace], start_limit, stop_limit, downsample)[0] \
+                        for trace in batch]
+        log.error('Could not load ' + batch[0].name + ': ' + error)
+        self.load_errors[batch[0].name] = error
+        return [None]
+
+    def log_load_report(self):
+        """Log a summary of the request latencies of the last
+        load_all"""
+        latencies = np.array([request['latency'] for request in self.load_report])
+        if not len(latencies):
+            return
+        log.info('%d requests, latency mean %.3fs, median %.3fs, 95th percentile %.3fs, max %.3fs, %d failed sensors' % \
+                     (len(latencies), latencies.mean(), np.median(latencies),
+                      np.percentile(latencies, 95), latencies.max(), len(self.load_errors)))
+
+    def get_batches(self, traces, start_limit=None, stop_limit=None):
+        """Group `traces' into lists that are loaded together: up to
+        batch_size TSDBTraces of the same location and limits, and any
+        other trace on its own"""
+        groups = {}
+        batches = []
+        for trace in traces:
+            if isinstance(trace, TSDBTrace):
+                key = (trace.loc, trace.get_limits(start_limit, stop_limit))
+                groups.setdefault(key, []).append(trace)
+            else:
+                batches.append([trace])
+        for group in groups.values():
+            batches.extend([group[index : index + self.batch_size] \
+                                for index in range(0, len(group), self.batch_size)])
+        return batches
 
     def get_sensor_types(self):
         """Returns the different types of sensors in the Trace"""
-        return set([trace.get_type() for trace in self.traces])
+        return set(self.type_index.keys())
 
     def get_traces_type(self, type):
         """Returns all Sensors of a given `type'"""
-        # self.__tsdb_trace_initialize(self.location)
-        return [trace for trace in self.traces \
-                    if trace.get_type() == type]
+        return list(self.type_index.get(type, []))
 
     def get_trace(self, sensor_name):
         """Given the name of the sensor retrieve the SensorTrace
         object"""
-        for trace in self.traces:
-            if trace.get_name().name == sensor_name:
-                return trace
+        return self.name_index.get(sensor_name)
+
+    def find_traces(self, pattern=None, type=None, room=None, floor=None):
+        """Returns the traces that match all of the given criteria.
+        `pattern' is a shell style wildcard pattern on the sensor
+        name, e.g. 'SODA4R4*__ART'. Room and floor only match sensors
+        within rooms (see Name.is_room)"""
+        selections = [index.get(key, []) for index, key in \
+                          ((self.type_index, type),
+                           (self.room_index, room),
+                           (self.floor_index, floor)) \
+                          if key is not None]
+        if selections:
+            traces = min(selections, key=len)
+            others = [set(selection) for selection in selections \
+                          if selection is not traces]
+            traces = [trace for trace in traces \
+                          if all([trace in other for other in others])]
+        else:
+            traces = self.traces
+        if pattern:
+            regex = re.compile(fnmatch.translate(pattern))
+            traces = [trace for trace in traces if regex.match(trace.name)]
+        return list(traces)
 
     def get_sensor_names(self):
         """Returns the names of all the sensors in the trace"""
@@ -317,12 +1293,13 @@ class TSTrace(object):
     def get_rooms(self, floor_no=None):
         """Get the room map of the building"""
         room_map = {}
-        for sensor in self.traces:
-            if not sensor.is_room():
-                continue
+        if floor_no:
+            sensors = self.floor_index.get(floor_no, [])
+        else:
+            sensors = [sensor for room_sensors in self.room_index.values() \
+                           for sensor in room_sensors]
+        for sensor in sensors:
             room_no = sensor.get_name().room_no
-            if floor_no and sensor.get_name().floor != floor_no:
-                continue
             sensor_type = sensor.get_name().type
             if not room_map.has_key(room_no):
                 room_map[room_no] = Room(room_no)
@@ -29,60 +29,409 @@ ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
 SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
-import types
-import datetime
+import multiprocessing
 from collections import defaultdict
 import numpy as np
+from common import to_epoch_array, utc_to_local
+
+# Statistics computed by aggregate
+STATS = ('count', 'mean', 'std', 'min', 'max', 'trapz')
+
+# Names of the buckets of get_bucket_keys that are not numbers
+BUCKET_LABELS = {'diurnal': ['daytime', 'nighttime']}
+
+# Largest range of keys that is counted with a dense bincount
+DENSE_KEYS = 1 << 20
 
 def conv_epoch_to_datetime(timestamps):
     """Convert a list of UNIX timestamps, i.e. the number of seconds
-    from epoch into a datetime object"""
-    return [datetime.datetime.fromtimestamp(ts) for ts in timestamps \
-                if type(ts) != datetime.datetime]
+    from epoch into an array of local datetime objects. datetime
+    objects and datetime64 values are taken as local time"""
+    timestamps = np.asarray(timestamps)
+    if timestamps.dtype.kind in 'iuf':
+        timestamps = utc_to_local(timestamps)
+    return to_epoch_array(timestamps).view('M8[s]').astype(object)
+
+def to_local_epochs(timestamps):
+    """Convert datetime objects, datetime64 values or seconds since
+    epoch into an int64 array of seconds since epoch in local wall
+    clock time. Numbers are taken to be in local wall clock time
+    already, as returned by DataCollection.get_epochs"""
+    return to_epoch_array(timestamps)
+
+def get_bucket_keys(timestamps, bucket):
+    """Compute the integer bucket of every timestamp (see
+    to_local_epochs) as an array. `bucket' is one of hour (of the
+    day), month (of the year), year, week (ISO week of the year), day
+    (of the year) or diurnal (0 for daytime, 1 for nighttime)"""
+    seconds = to_local_epochs(timestamps)
+    days = seconds // 86400
+    if bucket == 'hour':
+        return seconds // 3600 % 24
+    if bucket == 'diurnal':
+        hours = seconds // 3600 % 24
+        return ((hours > 18) | (hours < 6)).astype(np.int64)
+    if bucket == 'month':
+        return days.astype('M8[D]').astype('M8[M]').view(np.int64) % 12 + 1
+    if bucket == 'year':
+        return days.astype('M8[D]').astype('M8[Y]').view(np.int64) + 1970
+    if bucket == 'day':
+        years = days.astype('M8[D]').astype('M8[Y]').astype('M8[D]').view(np.int64)
+        return days - years + 1
+    if bucket == 'week':
+        # The ISO week is the week of its Thursday within the year of
+        # that Thursday. 1970-01-01 was a Thursday.
+        thursdays = days - (days + 3) % 7 + 3
+        years = thursdays.astype('M8[D]').astype('M8[Y]').astype('M8[D]').view(np.int64)
+        return (thursdays - years) // 7 + 1
+    raise ValueError("Unknown bucket: " + str(bucket))
+
+def aggregate(keys, values, stats=STATS):
+    """Group `values' by their integer `keys' and compute the given
+    `stats' (see STATS) of every group. Groups are counted with
+    bincount, so that there is no loop over values in Python.
+
+    Returns a dictionary with the sorted distinct keys under 'keys' and
+    an array for every statistic, in the order of the keys. std is the
+    population standard deviation and trapz is the trapezoidal
+    integral of the group in time order, divided by its count."""
+    keys = np.asarray(keys, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if len(keys) != len(values):
+        raise ValueError("Keys and values differ in length")
+    if not len(keys):
+        result = dict([(stat, np.empty(0)) for stat in stats])
+        result['keys'] = np.empty(0, dtype=np.int64)
+        return result
+
+    offset = keys.min()
+    if keys.max() - offset < DENSE_KEYS:
+        index = keys - offset
+        dense_count = np.bincount(index)
+        present = np.flatnonzero(dense_count)
+        if len(present) < len(dense_count):
+            # Renumber the groups to drop keys that do not occur
+            group = np.zeros(len(dense_count), dtype=np.int64)
+            group[present] = np.arange(len(present))
+            index = group[index]
+        unique_keys = present + offset
+    else:
+        unique_keys, index = np.unique(keys, return_inverse=True)
+
+    count = np.bincount(index).astype(np.float64)
+    sums = np.bincount(index, weights=values)
+    mean = sums / count
+    result = {'keys': unique_keys, 'count': count.astype(np.int64), 'mean': mean}
+    if 'std' in stats:
+        deviations = values - mean[index]
+        result['std'] = np.sqrt(np.bincount(index, weights=deviations * deviations) / count)
+    if 'min' in stats or 'max' in stats or 'trapz' in stats:
+        order = np.argsort(index, kind='mergesort')
+        starts = np.concatenate(([0], np.cumsum(count[:-1]).astype(np.int64)))
+        ordered = values[order]
+        if 'min' in stats:
+            result['min'] = np.minimum.reduceat(ordered, starts)
+        if 'max' in stats:
+            result['max'] = np.maximum.reduceat(ordered, starts)
+        if 'trapz' in stats:
+            stops = starts + count.astype(np.int64) - 1
+            trapz = sums - (ordered[starts] + ordered[stops]) / 2
+            result['trapz'] = np.where(count > 1, trapz, 0) / count
+    return dict([(key, result[key]) for key in ['keys'] + list(stats)])
 
 def get_distrib(timestamps, data, key_gen):
-    """Generic function to aggregate distribution of values"""
-    if timestamps and np.iterable(timestamps) and \
-            type(timestamps[0]) == types.IntType:
+    """Generic function to aggregate distribution of values.
+    `key_gen' is either the name of a bucket (see get_bucket_keys) or
+    a function that maps a datetime object to its key. For the
+    latter, integer timestamps are UNIX timestamps as they always
+    were (see conv_epoch_to_datetime)"""
+    if isinstance(key_gen, basestring):
+        bucket = key_gen
+        keys = get_bucket_keys(timestamps, bucket)
+        labels = None
+    else:
         timestamps = conv_epoch_to_datetime(timestamps)
-    vals = defaultdict(list)
-    avg_vals = defaultdict(float)
-    sd_vals = defaultdict(float)
-    trapz_vals = defaultdict(float)
-    count = defaultdict(int)
-    
-    for ts, data_val in zip(timestamps, data):
-        vals[key_gen(ts)].append(data_val)
-        count[key_gen(ts)] += 1
-
-    for key in count:
-        avg_vals[key] = np.sum(vals[key]) / count[key]
-        sd_vals[key] = np.std(vals[key])
-        trapz_vals[key] = np.trapz(vals[key]) / count[key] # Not returned as of now
+        labels, keys = np.unique([key_gen(ts) for ts in timestamps], return_inverse=True)
+        labels = labels.tolist()
+        bucket = None
 
+    aggregates = aggregate(keys, data, ('mean', 'std'))
+    keys = aggregates['keys'].tolist()
+    if labels is not None:
+        keys = [labels[key] for key in keys]
+    elif bucket in BUCKET_LABELS:
+        keys = [BUCKET_LABELS[bucket][key] for key in keys]
+    avg_vals = defaultdict(float, zip(keys, aggregates['mean'].tolist()))
+    sd_vals = defaultdict(float, zip(keys, aggregates['std'].tolist()))
     return avg_vals, sd_vals
     
 def get_monthly_distrib(timestamps, data):
     """Return the average value of data for each month of the year"""
-    return get_distrib(timestamps, data, lambda ts: ts.month)
+    return get_distrib(timestamps, data, 'month')
 
 def get_hourly_distrib(timestamps, data):
     """Return the average value of data for each hour of the day"""
-    return get_distrib(timestamps, data, lambda ts: ts.hour)
+    return get_distrib(timestamps, data, 'hour')
 
 def get_yearly_distrib(timestamps, data):
     """Return the average value of data for each year"""
-    return get_distrib(timestamps, data, lambda ts: ts.year)
+    return get_distrib(timestamps, data, 'year')
 
 def get_weekly_distrib(timestamps, data):
     """Return the average value of data for each week of the year"""
-    return get_distrib(timestamps, data, lambda ts: ts.isocalendar()[1])
+    return get_distrib(timestamps, data, 'week')
 
 def get_daily_distrib(timestamps, data):
     """Return the average value of data for each day of the year"""
-    return get_distrib(timestamps, data, lambda ts: ts.timetuple()[7])
+    return get_distrib(timestamps, data, 'day')
 
 def get_diurnal_distrib(timestamps, data):
     """Return the average value of data for day and night"""
-    return get_distrib(timestamps, data, lambda ts: 'nighttime' if ts.hour > 18 or ts.hour < 6 else 'daytime')
+    return get_distrib(timestamps, data, 'diurnal')
+
+def get_rollup_distrib(rollup, bucket):
+    """Distribution of a rollup (see rollup.py) as returned by
+    get_distrib, computed from the counts and sums of its rows rather
+    than the records. Every row has to fall in a single bucket: the
+    hourly rollup suits all buckets, the daily one all but hour and
+    diurnal"""
+    keys = get_bucket_keys(rollup['time'], bucket)
+    unique_keys, index = np.unique(keys, return_inverse=True)
+    count = np.bincount(index, weights=rollup['count'])
+    mean = np.bincount(index, weights=rollup['sum']) / count
+    variance = np.bincount(index, weights=rollup['sumsq']) / count - mean * mean
+    std = np.sqrt(np.maximum(variance, 0))
+    keys = unique_keys.tolist()
+    if bucket in BUCKET_LABELS:
+        keys = [BUCKET_LABELS[bucket][key] for key in keys]
+    return defaultdict(float, zip(keys, mean.tolist())), \
+        defaultdict(float, zip(keys, std.tolist()))
+
+def get_batch_distrib(series, bucket, workers=1):
+    """Aggregate the distribution of many sensors at once. `series' is
+    a list of (timestamps, data) pairs or of traces, whose
+    get_data_tuples is called. `bucket' is as for get_bucket_keys.
+    With more than one worker, the sensors are split across `workers'
+    processes.
+
+    Returns the list of bucket keys and sensors x buckets arrays of
+    the average and standard deviation of every sensor in every
+    bucket. Buckets without data of a sensor are NaN."""
+    series = [item.get_data_tuples() if hasattr(item, 'get_data_tuples') else item \
+                  for item in series]
+    series = [(to_local_epochs(timestamps).view('M8[s]'), np.asarray(data, dtype=np.float64)) \
+                  for timestamps, data in series]
+    if workers <= 1 or len(series) <= 1:
+        parts = [_aggregate_series((series, bucket))]
+    else:
+        size = -(-len(series) // workers)
+        pool = multiprocessing.Pool(min(workers, len(series)))
+        try:
+            parts = pool.map(_aggregate_series,
+                             [(series[index : index + size], bucket) \
+                                  for index in range(0, len(series), size)])
+        finally:
+            pool.close()
+            pool.join()
+
+    # Line up the buckets found by the workers
+    keys = reduce(np.union1d, [part[0] for part in parts])
+    avg_vals = np.empty((len(series), len(keys)))
+    sd_vals = np.empty((len(series), len(keys)))
+    row = 0
+    for part_keys, part_avg, part_sd in parts:
+        columns = np.searchsorted(keys, part_keys)
+        rows = slice(row, row + len(part_avg))
+        avg_vals[rows] = np.nan
+        sd_vals[rows] = np.nan
+        avg_vals[rows, columns] = part_avg
+        sd_vals[rows, columns] = part_sd
+        row += len(part_avg)
+    return _get_labels(keys, bucket), avg_vals, sd_vals
+
+def get_matrix_distrib(timestamps, matrix, bucket):
+    """Same as get_batch_distrib for data that is aligned to common
+    `timestamps', given as a sensors x time `matrix'. NaN values are
+    left out."""
+    matrix = np.atleast_2d(np.asarray(matrix, dtype=np.float64))
+    bucket_keys = get_bucket_keys(timestamps, bucket)
+    keys, index = np.unique(bucket_keys, return_inverse=True)
+    avg_vals, sd_vals = _aggregate_matrix(index, matrix, len(keys))
+    return _get_labels(keys, bucket), avg_vals, sd_vals
+
+def _aggregate_series(args):
+    """Aggregate a list of (datetime64 timestamps, data) pairs. Returns
+    the keys found and sensors x keys arrays of average and standard
+    deviation"""
+    series, bucket = args
+    bucket_keys = [get_bucket_keys(timestamps, bucket) for timestamps, data in series]
+    keys, index = np.unique(np.concatenate(bucket_keys + [np.empty(0, dtype=np.int64)]),
+                            return_inverse=True)
+    sensors = np.repeat(np.arange(len(series)), [len(key) for key in bucket_keys])
+    values = np.concatenate([data for timestamps, data in series] + [np.empty(0)])
+    avg_vals, sd_vals = _aggregate_groups(sensors * len(keys) + index, values,
+                                          len(series), len(keys))
+    return keys, avg_vals, sd_vals
+
+def _aggregate_matrix(index, matrix, key_count):
+    sensors = np.arange(matrix.shape[0])[:, np.newaxis]
+    groups = (sensors * key_count + index[np.newaxis, :]).ravel()
+    return _aggregate_groups(groups, matrix.ravel(), matrix.shape[0], key_count)
+
+def _aggregate_groups(groups, values, sensor_count, key_count):
+    """Average and standard deviation of `values' by `groups' (sensor
+    times key_count plus key), as sensor_count x key_count arrays"""
+    valid = ~np.isnan(values)
+    avg_vals = np.empty(sensor_count * key_count)
+    sd_vals = np.empty(sensor_count * key_count)
+    avg_vals[:] = np.nan
+    sd_vals[:] = np.nan
+    aggregates = aggregate(groups[valid], values[valid], ('mean', 'std'))
+    avg_vals[aggregates['keys']] = aggregates['mean']
+    sd_vals[aggregates['keys']] = aggregates['std']
+    return avg_vals.reshape(sensor_count, key_count), sd_vals.reshape(sensor_count, key_count)
+
+def _get_labels(keys, bucket):
+    keys = np.asarray(keys).tolist()
+    if bucket in BUCKET_LABELS:
+        return [BUCKET_LABELS[bucket][key] for key in keys]
+    return keys
+
+class BucketAggregate(object):
+    """Running statistics of values per bucket (see get_bucket_keys),
+    fed one chunk of data at a time.
+
+    Every bucket keeps its count, mean, sum of squared deviations
+    (Welford), minimum and maximum, which is all that is needed to
+    merge aggregates of different chunks or workers exactly. If `bins'
+    (an increasing array of bin edges) is given, a histogram of every
+    bucket is kept as well, from which quantiles are estimated."""
+
+    def __init__(self, bucket, bins=None):
+        self.bucket = bucket
+        self.bins = None if bins is None else np.asarray(bins, dtype=np.float64)
+        self.keys = np.empty(0, dtype=np.int64)
+        self.count = np.empty(0, dtype=np.int64)
+        self.mean = np.empty(0)
+        self.m2 = np.empty(0)
+        self.min = np.empty(0)
+        self.max = np.empty(0)
+        self.histogram = None
+        if self.bins is not None:
+            self.histogram = np.empty((0, len(self.bins) + 1), dtype=np.int64)
+
+    def update(self, timestamps, data):
+        """Add a chunk of data. NaN values are left out. Returns the
+        aggregate itself"""
+        values = np.asarray(data, dtype=np.float64)
+        valid = ~np.isnan(values)
+        keys = get_bucket_keys(timestamps, self.bucket)[valid]
+        values = values[valid]
+        if not len(values):
+            return self
+        stats = aggregate(keys, values, ('count', 'mean', 'std', 'min', 'max'))
+        chunk = BucketAggregate(self.bucket, self.bins)
+        chunk.keys = stats['keys']
+        chunk.count = stats['count']
+        chunk.mean = stats['mean']
+        chunk.m2 = stats['std'] ** 2 * stats['count']
+        chunk.min = stats['min']
+        chunk.max = stats['max']
+        if self.bins is not None:
+            columns = len(self.bins) + 1
+            index = np.searchsorted(chunk.keys, keys) * columns + \
+                np.searchsorted(self.bins, values, side='right')
+            chunk.histogram = np.bincount(index, minlength=len(chunk.keys) * columns) \
+                .reshape(len(chunk.keys), columns)
+        return self.merge(chunk)
+
+    def merge(self, other):
+        """Combine the statistics of `other', an aggregate of the same
+        bucket and bins, into this one. Returns the aggregate itself"""
+        keys = np.union1d(self.keys, other.keys).astype(np.int64)
+        mine = np.searchsorted(keys, self.keys)
+        theirs = np.searchsorted(keys, other.keys)
+
+        def spread(positions, values, fill):
+            result = np.empty(len(keys), dtype=np.asarray(values).dtype)
+            result[:] = fill
+            result[positions] = values
+            return result
+        count_a = spread(mine, self.count, 0)
+        count_b = spread(theirs, other.count, 0)
+        mean_a = spread(mine, self.mean, 0)
+        mean_b = spread(theirs, other.mean, 0)
+        count = count_a + count_b
+        delta = mean_b - mean_a
+        # Chan et al., pairwise combination of means and variances
+        self.mean = mean_a + delta * count_b / count
+        self.m2 = spread(mine, self.m2, 0) + spread(theirs, other.m2, 0) + \
+            delta * delta * count_a * count_b / count
+        self.min = np.minimum(spread(mine, self.min, np.inf), spread(theirs, other.min, np.inf))
+        self.max = np.maximum(spread(mine, self.max, -np.inf), spread(theirs, other.max, -np.inf))
+        if self.histogram is not None:
+            histogram = np.zeros((len(keys), self.histogram.shape[1]), dtype=np.int64)
+            histogram[mine] += self.histogram
+            histogram[theirs] += other.histogram
+            self.histogram = histogram
+        self.keys = keys
+        self.count = count
+        return self
+
+    def get_std(self):
+        return np.sqrt(self.m2 / self.count)
+
+    def get_distrib(self):
+        """Returns the average and standard deviation of every bucket,
+        as returned by get_distrib"""
+        keys = _get_labels(self.keys, self.bucket)
+        return defaultdict(float, zip(keys, self.mean.tolist())), \
+            defaultdict(float, zip(keys, self.get_std().tolist()))
+
+    def get_quantiles(self, q):
+        """Estimate the `q' quantile (0 to 1) of every bucket from the
+        histogram, interpolating linearly within bins. Requires bins"""
+        if self.histogram is None:
+            raise ValueError("Quantiles require an aggregate with bins")
+        quantiles = np.empty(len(self.keys))
+        for index in range(len(self.keys)):
+            cumulative = np.cumsum(self.histogram[index])
+            target = q * self.count[index]
+            column = min(np.searchsorted(cumulative, target), len(cumulative) - 1)
+            while not self.histogram[index, column]:
+                column += 1
+            lower = self.bins[column - 1] if column > 0 else self.min[index]
+            upper = self.bins[column] if column < len(self.bins) else self.max[index]
+            lower, upper = max(lower, self.min[index]), min(upper, self.max[index])
+            before = cumulative[column - 1] if column > 0 else 0
+            quantiles[index] = lower + (upper - lower) * \
+                (target - before) / self.histogram[index, column]
+        return quantiles
+
+def aggregate_chunks(chunks, bucket, bins=None):
+    """Build a BucketAggregate from an iterator of (timestamps, data)
+    chunks, such as SensorTrace.iter_chunks"""
+    result = BucketAggregate(bucket, bins)
+    for timestamps, data in chunks:
+        result.update(timestamps, data)
+    return result
+
+def aggregate_traces(traces, bucket, start_limit=None, stop_limit=None, bins=None,
+                     workers=1):
+    """Aggregate every trace chunk by chunk (see
+    SensorTrace.iter_chunks), spreading the traces across `workers'
+    processes. Returns a BucketAggregate per trace; merge them for
+    building wide statistics"""
+    jobs = [(trace, bucket, start_limit, stop_limit, bins) for trace in traces]
+    if workers <= 1 or len(jobs) <= 1:
+        return [_aggregate_trace(job) for job in jobs]
+    pool = multiprocessing.Pool(min(workers, len(jobs)))
+    try:
+        return pool.map(_aggregate_trace, jobs)
+    finally:
+        pool.close()
+        pool.join()
 
+def _aggregate_trace(args):
+    trace, bucket, start_limit, stop_limit, bins = args
+    return aggregate_chunks(trace.iter_chunks(start_limit, stop_limit), bucket, bins)
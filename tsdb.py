@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Author:  prashmohan@gmail.com
+         http://www.cs.berkeley.edu/~prmohan
+        
+Copyright (c) 2011, University of California at Berkeley
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+    * Redistributions of source code must retain the above copyright
+      notice, this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright
+      notice, this list of conditions and the following disclaimer in the
+      documentation and/or other materials provided with the distribution.
+    * Neither the name of University of California, Berkeley nor the
+      names of its contributors may be used to endorse or promote products
+      derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL PRASHANTH MOHAN BE LIABLE FOR ANY
+DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+"""
+
+import time
+import socket
+import httplib
+import logging
+import threading
+import itertools
+import collections
+import numpy as np
+from common import parse_numbers, count_fields
+
+log = logging.getLogger(__name__)
+
+
+class ConnectionPool(object):
+    """Thread safe pool of keep-alive HTTP connections to an OpenTSDB
+    location (host:port).
+
+    At most `size' connections are open at a time; further requests
+    wait for a connection to be returned. Requests that fail with a
+    connection error or a 502, 503 or 504 response are retried up to
+    `retries' times, sleeping `backoff' seconds before the first retry
+    and doubling the wait for every further one."""
+
+    DEFAULT_SIZE = 8
+    RETRIES = 3
+    BACKOFF = 0.2
+    TRANSIENT_STATUS = (502, 503, 504)
+
+    def __init__(self, location, size=DEFAULT_SIZE, retries=RETRIES, backoff=BACKOFF,
+                 timeout=None):
+        self.location = location
+        self.size = size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.requests = 0
+        self.connections = 0
+        self.failures = 0
+        self.__idle = []
+        self.__active = 0
+        self.__condition = threading.Condition()
+
+    def request(self, path, reader=None):
+        """Send a GET request for `path' and return the status, reason
+        and body of the response. If given, `reader' is called with
+        the response of a successful request to consume the body
+        instead and its result is returned as the body. Raises the
+        last httplib or socket error once all retries failed"""
+        attempt = 0
+        while True:
+            conn, reused = self.__acquire()
+            try:
+                conn.request('GET', path)
+                response = conn.getresponse()
+                if reader and response.status == 200:
+                    body = reader(response)
+                else:
+                    body = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                self.__release(conn, False)
+                self.failures += 1
+                # The server may have closed an idle connection, which
+                # is retried right away on a new connection
+                if reused:
+                    continue
+                if attempt >= self.retries:
+                    raise
+                log.warn('Request to ' + self.location + ' failed: ' + str(e))
+            except:
+                self.__release(conn, False)
+                raise
+            else:
+                self.__release(conn, not response.will_close)
+                if response.status not in self.TRANSIENT_STATUS or \
+                        attempt >= self.retries:
+                    self.requests += 1
+                    return response.status, response.reason, body
+                self.failures += 1
+                log.warn('Request to ' + self.location + ' failed: ' + response.reason)
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def set_size(self, size):
+        """Change the number of connections kept open"""
+        self.__condition.acquire()
+        try:
+            self.size = size
+            while len(self.__idle) > size:
+                self.__idle.pop().close()
+            self.__condition.notify_all()
+        finally:
+            self.__condition.release()
+
+    def close(self):
+        """Close the idle connections"""
+        self.__condition.acquire()
+        try:
+            for conn in self.__idle:
+                conn.close()
+            self.__idle = []
+        finally:
+            self.__condition.release()
+
+    def get_stats(self):
+        return {'requests': self.requests, 'connections': self.connections,
+                'failures': self.failures, 'idle': len(self.__idle),
+                'active': self.__active}
+
+    def __acquire(self):
+        """Returns a connection and whether it was used before"""
+        self.__condition.acquire()
+        try:
+            while self.__active >= self.size:
+                self.__condition.wait()
+            self.__active += 1
+            if self.__idle:
+                return self.__idle.pop(), True
+            self.connections += 1
+        finally:
+            self.__condition.release()
+        return httplib.HTTPConnection(self.location, timeout=self.timeout), False
+
+    def __release(self, conn, keep):
+        self.__condition.acquire()
+        try:
+            self.__active -= 1
+            if keep and len(self.__idle) < self.size:
+                self.__idle.append(conn)
+            else:
+                conn.close()
+            self.__condition.notify()
+        finally:
+            self.__condition.release()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(location):
+    """Returns the ConnectionPool shared by all requests to
+    `location'"""
+    _pools_lock.acquire()
+    try:
+        if location not in _pools:
+            _pools[location] = ConnectionPool(location)
+        return _pools[location]
+    finally:
+        _pools_lock.release()
+
+
+# Bytes of a response parsed at a time
+BLOCK_SIZE = 1 << 20
+
+
+def parse_ascii(stream, block_size=BLOCK_SIZE):
+    """Parse the ascii response of a /q query, reading `stream' (a
+    file like object such as an HTTPResponse) one block at a time.
+
+    Returns a dictionary of metric name to an int64 array of
+    timestamps (UNIX time) and a float64 array of values. Only the
+    arrays and a single block of text are held in memory."""
+    blocks = collections.defaultdict(list)
+    rest = ''
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            break
+        block = rest + block
+        end = block.rfind('\n') + 1
+        rest = block[end:]
+        _parse_lines(block[:end], blocks)
+    _parse_lines(rest, blocks)
+
+    arrays = {}
+    for metric, parts in blocks.items():
+        arrays[metric] = (np.concatenate([part[0] for part in parts]),
+                          np.concatenate([part[1] for part in parts]))
+    return arrays
+
+
+def _parse_lines(text, blocks):
+    """Parse complete lines of `metric timestamp value tags' and add
+    the arrays of every metric to `blocks'"""
+    fields = text.split()
+    if not fields:
+        return
+    counts = count_fields(text)
+    counts = counts[counts > 0]
+    columns = counts[0]
+    if columns < 3 or (counts != columns).any():
+        # Lines have differing numbers of tags. Split them one by one.
+        rows = [line.split(None, 3) for line in text.split('\n') if line.strip()]
+        fields = [field for row in rows for field in row[:3]]
+        columns = 3
+    metrics = fields[0 :: columns]
+    timestamps = parse_numbers(fields[1 :: columns], np.int64)
+    values = parse_numbers(fields[2 :: columns], np.float64)
+
+    # The lines of a metric come one after the other
+    start = 0
+    for metric, lines in itertools.groupby(metrics):
+        stop = start + len(list(lines))
+        blocks[metric].append((timestamps[start : stop], values[start : stop]))
+        start = stop